@@ -0,0 +1,167 @@
+from __future__ import annotations
+from pathlib import Path
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Benchmarks, to be run from the repository root:
+#
+#   python src/bench.py startup                          measure
+#   python src/bench.py startup --save bench.json        measure and keep as the baseline
+#   python src/bench.py startup --baseline bench.json    fail if slower than the baseline
+#   python src/bench.py scorer                           score_similarity, compiled and generic
+#
+# The first-prompt timing launches main.py, so it needs src/config.ini.
+
+PATH_SRC = Path(__file__).parent
+
+def time_import(module: str) -> float:
+    """Seconds for a fresh interpreter to import module."""
+    ts = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import {module}'], cwd=PATH_SRC, check=True)
+    return time.perf_counter() - ts
+
+def time_first_prompt(marker: bytes=b'Choice', timeout: float=30.0) -> float:
+    """Seconds from launching main.py until its menu asks for a choice."""
+    ts = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(PATH_SRC / 'main.py')], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    output = b''
+    try:
+        while marker not in output:
+            chunk = proc.stdout.read1(4096)
+            if (not chunk) or (time.perf_counter() - ts > timeout):
+                raise RuntimeError(f'main.py never prompted; it said: {output.decode(errors="replace")}')
+            output += chunk
+        return time.perf_counter() - ts
+
+    finally:
+        proc.kill()
+        proc.wait()
+
+def bench_startup(repeat: int) -> dict[str, float]:
+    results = {}
+    for (name, measure) in (
+        ('import_main', lambda: time_import('main')),
+        ('import_library', lambda: time_import('library')),
+        ('first_prompt', time_first_prompt)):
+
+        measure() # Warm up the disk cache and bytecode
+        results[name] = statistics.median(measure() for _ in range(repeat))
+
+    return results
+
+def make_pairs(n: int) -> tuple[list[tuple], list[tuple]]:
+    """n pairs of similar tracks and of albums built from them, with tags that differ a little."""
+    import random
+    sys.path.insert(0, str(PATH_SRC))
+    from library import Album, Track
+
+    rng = random.Random(0)
+    words = ['love', 'night', 'blue', 'river', 'song', 'heart', 'road', 'light', 'home', 'rain']
+
+    def _track(folder: Path, i: int, title: str, artist: str) -> Track:
+        data = {
+            'filename': f'{i:02}{title}', 'albumname': folder.name.lower(), 'title': title, 'artist': artist,
+            'albumartist': artist, 'track': i, 'composer': None, 'genre': 'rock', 'duration': 180.0 + rng.random() * 60
+        }
+        return Track(folder / f'{i:02} {title}.mp3', data)
+
+    track_pairs, album_pairs = [], []
+    for k in range(n):
+        artist = ''.join(rng.sample(words, 2))
+        name = ' '.join(rng.sample(words, 3)).title()
+        a, b = Album(Path(f'/old/{artist}/{name}')), Album(Path(f'/new/{artist}/{name} (Remaster)'))
+
+        for i in range(1, 11):
+            title = ''.join(rng.sample(words, 3))
+            t, u = _track(a.path, i, title, artist), _track(b.path, i, title + ('remastered' if i % 3 == 0 else ''), artist)
+            for (album, track) in ((a, t), (b, u)):
+                album.tracks[str(track.path)] = track
+                album.update_data(track)
+            track_pairs.append((t, u))
+
+        album_pairs.append((a, b))
+
+    return track_pairs, album_pairs
+
+def bench_scorer(repeat: int) -> dict[str, float]:
+    """Seconds per 1,000 scored pairs."""
+    import matching
+
+    track_pairs, album_pairs = make_pairs(100)
+    results = {}
+    for (kind, pairs) in (('tracks', track_pairs), ('albums', album_pairs)):
+        for (name, score) in (('generic', matching.score_similarity_generic), ('compiled', matching.score_similarity)):
+
+            # The two must agree before either is worth timing
+            for (m1, m2) in pairs:
+                expected = matching.score_similarity_generic(m1, m2)[0]
+                if abs(score(m1, m2)[0] - expected) > 1e-9:
+                    raise RuntimeError(f'{name} scorer disagrees on {m1.path} vs {m2.path}')
+
+            def _measure() -> float:
+                ts = time.perf_counter()
+                for (m1, m2) in pairs:
+                    score(m1, m2)
+                return (time.perf_counter() - ts) * 1_000 / len(pairs)
+
+            # The fastest run is the one least disturbed by everything else on the machine
+            _measure()
+            results[f'score_{kind}_{name}'] = min(_measure() for _ in range(repeat))
+
+    for kind in ('tracks', 'albums'):
+        print(f'{kind}: compiled is {results[f"score_{kind}_generic"] / results[f"score_{kind}_compiled"]:.1f}x as fast')
+    return results
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'scorer': bench_scorer
+}
+
+def compare(results: dict[str, float], baseline: dict[str, float], tolerance: float) -> bool:
+    ok = True
+    for (name, seconds) in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = seconds / baseline[name]
+        verdict = 'ok'
+        if ratio > 1 + tolerance:
+            verdict = 'REGRESSED'
+            ok = False
+
+        print(f'{name:<24} {baseline[name] * 1_000:>9.1f} ms -> {seconds * 1_000:>9.1f} ms  ({ratio:.2f}x) {verdict}')
+
+    return ok
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks for music-integration')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', type=Path, help='write the results here as the new baseline')
+    parser.add_argument('--baseline', type=Path, help='compare against results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before failing, as a fraction')
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.benchmark](args.repeat)
+    for (name, seconds) in results.items():
+        print(f'{name:<24} {seconds * 1_000:>9.1f} ms')
+
+    if args.save:
+        saved = json.loads(args.save.read_text()) if args.save.exists() else {}
+        saved.update(results)
+        args.save.write_text(json.dumps(saved, indent=4))
+
+    if args.baseline:
+        print()
+        if not compare(results, json.loads(args.baseline.read_text()), args.tolerance):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
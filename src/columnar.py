@@ -0,0 +1,327 @@
+from __future__ import annotations
+from array import array
+from collections.abc import MutableMapping
+from numbers import Number
+from pathlib import Path
+from library import Album, LibraryRoot, Track
+import json
+import mmap
+import os
+import struct
+import weakref
+
+# A library root stored column by column in one file, for memory-mapping.
+#
+#   magic, header length, header (JSON: path_base, moves, counts, sections)
+#   sections, each 8-byte aligned:
+#       strings.offsets, strings.blob            every string, stored once
+#       albums.path, albums.ts_seen, albums.start, albums.stop
+#       tracks.path, tracks.album, tracks.ts_seen, tracks.size, tracks.mtime, tracks.digest
+#       tracks.<field>.kind, tracks.<field>.value for each field in Track.weights
+#
+# Tracks are stored album by album, so an album's tracks are one contiguous range.
+# Strings are referenced by their index in the string table; -1 means None.
+
+MAGIC = b'MILC0001'
+
+# Roots still mapping their file. Windows won't replace a file that is mapped,
+# so saving over one first releases every root that maps it.
+_loaded: weakref.WeakSet[LibraryRoot] = weakref.WeakSet()
+
+KIND_NONE = 0
+KIND_STR = 1
+KIND_INT = 2
+KIND_FLOAT = 3
+
+def save(root: LibraryRoot, path: Path) -> None:
+    strings = {}
+
+    def _sid(s: str) -> int:
+        if s is None:
+            return -1
+        return strings.setdefault(s, len(strings))
+
+    cols = {
+        'albums.path': array('q'), 'albums.ts_seen': array('q'), 'albums.start': array('q'), 'albums.stop': array('q'),
+        'tracks.path': array('q'), 'tracks.album': array('q'), 'tracks.ts_seen': array('q'),
+        'tracks.size': array('q'), 'tracks.mtime': array('q'), 'tracks.digest': array('q')
+    }
+    for field in Track.weights:
+        cols[f'tracks.{field}.kind'] = array('b')
+        cols[f'tracks.{field}.value'] = array('d')
+
+    for (j, a) in enumerate(root.albums.values()):
+        cols['albums.path'].append(_sid(str(a.path)))
+        cols['albums.ts_seen'].append(a.ts_seen)
+        cols['albums.start'].append(len(cols['tracks.path']))
+
+        for t in a.tracks.values():
+            cols['tracks.path'].append(_sid(str(t.path)))
+            cols['tracks.album'].append(j)
+            cols['tracks.ts_seen'].append(t.ts_seen)
+
+            # Tracks from before move detection don't know these
+            size = getattr(t, 'size', None)
+            mtime = getattr(t, 'mtime', None)
+            cols['tracks.size'].append(-1 if size is None else size)
+            cols['tracks.mtime'].append(-1 if mtime is None else mtime)
+            cols['tracks.digest'].append(_sid(getattr(t, 'digest', None)))
+
+            for field in Track.weights:
+                kind, value = _encode(t.data.get(field), _sid)
+                cols[f'tracks.{field}.kind'].append(kind)
+                cols[f'tracks.{field}.value'].append(value)
+
+        cols['albums.stop'].append(len(cols['tracks.path']))
+
+    blobs = [s.encode('utf-8', 'surrogateescape') for s in strings]
+    offsets = array('q', [0])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+
+    sections = {'strings.offsets': offsets, 'strings.blob': b''.join(blobs)}
+    sections.update(cols)
+
+    release_path(path)
+    write_sections(path, MAGIC, {
+        'path_base': str(root.path_base),
+        'moves': root.moves,
+        'n_albums': len(cols['albums.path']),
+        'n_tracks': len(cols['tracks.path']),
+        'fields': list(Track.weights)
+    }, sections)
+
+def write_sections(path: Path, magic: bytes, header: dict, sections: dict[str, array | bytes]) -> None:
+    """Write magic, a JSON header and 8-byte aligned sections, swapping the file in whole."""
+
+    # Lay the sections out after the header, which must know where they go
+    layout = {}
+    position = 0
+    for (name, data) in sections.items():
+        n_bytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        layout[name] = (position, n_bytes, typecode)
+        position += _pad(n_bytes)
+
+    header = json.dumps(dict(header, sections=layout)).encode()
+    start = _pad(len(magic) + 8 + len(header))
+
+    path_tmp = Path(f'{path}.tmp')
+    with open(path_tmp, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (start - f.tell()))
+
+        for (name, data) in sections.items():
+            offset, n_bytes, _ = layout[name]
+            f.write(data.tobytes() if isinstance(data, array) else data)
+            f.write(b'\0' * (_pad(n_bytes) - n_bytes))
+
+    os.replace(path_tmp, path)
+
+def load(path: Path) -> LibraryRoot:
+    """Map a saved root. Tracks and albums are only built when first looked up."""
+    if not Path.exists(path):
+        return None
+
+    store = Store(path)
+    if store.fields != list(Track.weights):
+        store.close()
+        return None # Written for a different Track schema; scan afresh
+
+    root = LibraryRoot(Path(store.header['path_base']))
+    root.moves = store.header['moves']
+    root.tracks = LazyMapping(store.track_keys, store.track)
+    root.albums = LazyMapping(store.album_keys, store.album)
+    root.store = store
+    _loaded.add(root)
+    return root
+
+def release(root: LibraryRoot) -> None:
+    """Materialize everything and unmap the file, e.g. before it is overwritten."""
+    store = getattr(root, 'store', None)
+    if store is None:
+        return
+
+    root.tracks = dict(root.tracks)
+    root.albums = dict(root.albums)
+    del root.store
+    store.close()
+    _loaded.discard(root)
+
+def release_path(path: Path) -> None:
+    """Release every root still mapping the file at path."""
+    for root in list(_loaded):
+        if Path(root.store.path).resolve() == Path(path).resolve():
+            release(root)
+
+def _encode(v: object, sid: callable) -> tuple[int, float]:
+    if v is None:
+        return KIND_NONE, 0.0
+    elif isinstance(v, str):
+        return KIND_STR, float(sid(v))
+    elif isinstance(v, int):
+        return KIND_INT, float(v)
+    elif isinstance(v, Number):
+        return KIND_FLOAT, float(v)
+    else:
+        raise TypeError(f'cannot store {v}, type {type(v)}')
+
+def decode_fields(sections: Sections, fields: list[str], i: int, prefix: str='tracks') -> dict[str, object]:
+    """Row i of the <prefix>.<field> columns."""
+    cols = sections.cols
+
+    data = {}
+    for field in fields:
+        kind, value = cols[f'{prefix}.{field}.kind'][i], cols[f'{prefix}.{field}.value'][i]
+        if kind == KIND_STR:
+            data[field] = sections.string(int(value))
+        elif kind == KIND_INT:
+            data[field] = int(value)
+        elif kind == KIND_FLOAT:
+            data[field] = value
+        else:
+            data[field] = None
+    return data
+
+def _pad(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+class Sections:
+    """The sections of a file written by write_sections, read straight out of the mapping."""
+    header: dict
+    cols: dict[str, memoryview]
+
+    def __init__(self: Sections, path: Path, magic: bytes) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(magic)] != magic:
+            self.mm.close()
+            raise ValueError(f'{path} is not a {magic.decode()} file')
+
+        (n_header,) = struct.unpack_from('<q', self.mm, len(magic))
+        self.header = json.loads(self.mm[len(magic) + 8:len(magic) + 8 + n_header])
+        start = _pad(len(magic) + 8 + n_header)
+
+        self.views = [memoryview(self.mm)]
+        self.cols = {}
+        for (name, (offset, n_bytes, typecode)) in self.header['sections'].items():
+            raw = self.views[0][start + offset:start + offset + n_bytes]
+            self.views.append(raw)
+            self.cols[name] = raw.cast(typecode)
+            self.views.append(self.cols[name])
+
+    def string(self: Sections, i: int) -> str:
+        if i < 0:
+            return None
+        offsets = self.cols['strings.offsets']
+        return bytes(self.cols['strings.blob'][offsets[i]:offsets[i + 1]]).decode('utf-8', 'surrogateescape')
+
+    def close(self: Sections) -> None:
+        for view in reversed(self.views):
+            view.release()
+        self.cols = {}
+        self.mm.close()
+
+class Store(Sections):
+    """The columns of one library root."""
+    made: dict[int, Album]
+
+    def __init__(self: Store, path: Path) -> None:
+        super().__init__(path, MAGIC)
+        self.fields = self.header['fields']
+        self.made = {}
+
+    def track_keys(self: Store) -> list[str]:
+        return [self.string(i) for i in self.cols['tracks.path']]
+
+    def album_keys(self: Store) -> list[Path]:
+        return [Path(self.string(i)) for i in self.cols['albums.path']]
+
+    def album(self: Store, j: int) -> Album:
+        if j in self.made:
+            return self.made[j]
+
+        cols = self.cols
+        a = Album(Path(self.string(cols['albums.path'][j])), cols['albums.ts_seen'][j])
+        for i in range(cols['albums.start'][j], cols['albums.stop'][j]):
+            t = self.build_track(i)
+            t.album = a
+            a.tracks[str(t.path)] = t
+        a.rebuild_data()
+
+        self.made[j] = a
+        return a
+
+    def track(self: Store, i: int) -> Track:
+        a = self.album(self.cols['tracks.album'][i])
+        return a.tracks[self.string(self.cols['tracks.path'][i])]
+
+    def build_track(self: Store, i: int) -> Track:
+        cols = self.cols
+        data = decode_fields(self, self.fields, i)
+
+        t = Track(Path(self.string(cols['tracks.path'][i])), data, ts=cols['tracks.ts_seen'][i])
+        size, mtime = cols['tracks.size'][i], cols['tracks.mtime'][i]
+        t.size = None if size < 0 else size
+        t.mtime = None if mtime < 0 else mtime
+        t.digest = self.string(cols['tracks.digest'][i])
+        t.duration_deferred = data.get('duration') is None
+        return t
+
+class LazyMapping(MutableMapping):
+    """A dict over stored rows that builds each value the first time it is looked up."""
+
+    def __init__(self: LazyMapping, keys: callable, load: callable) -> None:
+        self._keys = keys
+        self._load = load
+        self._index = None
+        self._made = {}
+        self._deleted = set()
+
+    def index(self: LazyMapping) -> dict[object, int]:
+        if self._index is None:
+            self._index = {k: i for (i, k) in enumerate(self._keys())}
+        return self._index
+
+    def __contains__(self: LazyMapping, key: object) -> bool:
+        if key in self._made:
+            return True
+        return (key not in self._deleted) and (key in self.index())
+
+    def __getitem__(self: LazyMapping, key: object) -> object:
+        if key in self._made:
+            return self._made[key]
+        if (key in self._deleted) or (key not in self.index()):
+            raise KeyError(key)
+
+        v = self._made[key] = self._load(self.index()[key])
+        return v
+
+    def __setitem__(self: LazyMapping, key: object, v: object) -> None:
+        self._made[key] = v
+        self._deleted.discard(key)
+
+    def __delitem__(self: LazyMapping, key: object) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._made.pop(key, None)
+        self._deleted.add(key)
+
+    def __iter__(self: LazyMapping):
+        index = self.index()
+        for k in index:
+            if k not in self._deleted:
+                yield k
+        for k in list(self._made):
+            if k not in index:
+                yield k
+
+    def __len__(self: LazyMapping) -> int:
+        return sum(1 for _ in self)
+
+    def copy(self: LazyMapping) -> dict:
+        return dict(self)
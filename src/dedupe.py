@@ -0,0 +1,94 @@
+from __future__ import annotations
+from library import Album
+import hashlib
+import matching
+import random
+import re
+import tools
+
+# Near-duplicate albums within one library. Each album is reduced to a set
+# of tokens and a MinHash signature of them; albums whose signatures agree
+# on any whole band land in the same LSH bucket and become candidate pairs.
+# Only those pairs are scored, so the work grows with the library rather
+# than with its square.
+
+N_BANDS = 16
+N_ROWS = 4 # Per band; albums sharing about half their tokens are likely to collide
+MAX_BUCKET = 50 # Buckets bigger than this say more about a common token than a duplicate
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0)
+_COEFFS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(N_BANDS * N_ROWS)]
+
+def get_tokens(a: Album) -> set[str]:
+    tokens = set()
+
+    for artist in a.data['albumartists']:
+        tokens.add(f'artist:{artist}')
+
+    for word in re.findall(r'\w+', a.path.name.casefold()):
+        tokens.add(f'word:{word}')
+
+    title = tools.normalize_title(a.path.name)
+    for i in range(len(title) - 2):
+        tokens.add(f'tri:{title[i:i + 3]}')
+
+    # Duration profile: track lengths to the nearest 5 seconds
+    for t in a.tracks.values():
+        if t.data['duration'] is not None:
+            tokens.add(f'dur:{round(t.data["duration"] / 5)}')
+
+    tokens.add(f'n:{a.data["n_tracks"]}')
+    return tokens
+
+def get_signature(tokens: set[str]) -> list[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little') for token in tokens]
+    if not hashes:
+        return []
+    return [min((m * h + c) % _PRIME for h in hashes) for (m, c) in _COEFFS]
+
+def find_candidate_pairs(albums: list[Album]) -> set[tuple[int, int]]:
+    buckets = {}
+    for (i, a) in enumerate(albums):
+        sig = get_signature(get_tokens(a))
+        if not sig:
+            continue
+
+        for band in range(N_BANDS):
+            key = (band, tuple(sig[band * N_ROWS:(band + 1) * N_ROWS]))
+            buckets.setdefault(key, []).append(i)
+
+    pairs = set()
+    for members in buckets.values():
+        if 1 < len(members) <= MAX_BUCKET:
+            for (n, i) in enumerate(members):
+                for j in members[n + 1:]:
+                    pairs.add((i, j))
+
+    return pairs
+
+def find_clusters(albums: list[Album], threshold: float) -> list[list[tuple[Album, Album, float]]]:
+    """Groups of albums linked by pairs that score at least threshold, with those pairs."""
+    pairs = find_candidate_pairs(albums)
+
+    # Union-find over the confirmed pairs
+    parent = list(range(len(albums)))
+
+    def _find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    links = []
+    for (i, j) in pairs:
+        score, _, _ = matching.score_similarity(albums[i], albums[j])
+        if score >= threshold:
+            links.append((i, j, score))
+            parent[_find(i)] = _find(j)
+
+    clusters = {}
+    for (i, j, score) in links:
+        clusters.setdefault(_find(i), []).append((albums[i], albums[j], score))
+
+    return sorted(clusters.values(), key=lambda links: max(score for (_, _, score) in links), reverse=True)
@@ -0,0 +1,148 @@
+from __future__ import annotations
+from collections import deque
+from multiprocessing.managers import BaseManager
+import multiprocessing
+import sys
+import threading
+import time
+import workers
+
+# Matching spread over several machines. The coordinator holds the work
+# units; workers connect over a socket, fetch the candidate pool once, then
+# lease units one at a time. A unit whose lease runs out is handed to the
+# next worker that asks, so a lost worker only costs its current unit.
+# Workers on this machine skip the pool: they map feature tables the
+# coordinator's process wrote, and take each unit as a range of their rows.
+
+KIND_ALBUMS = 'albums'
+KIND_TRACKS = 'tracks'
+
+class Coordinator:
+    kind: str
+    pool: list
+    params: dict
+    units: dict[int, list]
+    todo: deque[int]
+    leased: dict[int, float]
+    results: dict[int, dict]
+
+    def __init__(self: Coordinator, kind: str, units: list[list], pool: list, params: dict, lease: float) -> None:
+        self.kind = kind
+        self.units = dict(enumerate(units))
+        self.starts = [0]
+        for unit in units:
+            self.starts.append(self.starts[-1] + len(unit))
+        self.pool = pool
+        self.params = params
+        self.lease_time = lease
+        self.todo = deque(self.units)
+        self.leased = {}
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def get_job(self: Coordinator) -> tuple[str, list, dict]:
+        return self.kind, self.pool, self.params
+
+    def get_params(self: Coordinator) -> tuple[str, dict]:
+        return self.kind, self.params
+
+    def span(self: Coordinator, unit_id: int) -> tuple[int, int]:
+        """The rows of the items table a unit covers; units are consecutive slices of the items."""
+        return self.starts[unit_id], self.starts[unit_id + 1]
+
+    def lease(self: Coordinator, rows: bool=False) -> tuple[int, list]:
+        """
+        A unit to work on, as its items or with rows as its span; (None, None)
+        when there is nothing yet; (-1, None) when all is done.
+        """
+        with self.lock:
+            self.expire()
+
+            if not self.todo:
+                return (-1, None) if self.is_done() else (None, None)
+
+            unit_id = self.todo.popleft()
+            self.leased[unit_id] = time.monotonic()
+            return unit_id, self.span(unit_id) if rows else self.units[unit_id]
+
+    def complete(self: Coordinator, unit_id: int, result: dict) -> None:
+        with self.lock:
+            # A unit can come back twice if its lease ran out; the first answer stands
+            if unit_id not in self.results:
+                self.results[unit_id] = result
+            self.leased.pop(unit_id, None)
+
+    def expire(self: Coordinator) -> None:
+        now = time.monotonic()
+        for (unit_id, ts) in list(self.leased.items()):
+            if now - ts > self.lease_time:
+                del self.leased[unit_id]
+                if unit_id not in self.results:
+                    self.todo.append(unit_id)
+
+    def is_done(self: Coordinator) -> bool:
+        return len(self.results) == len(self.units)
+
+    def n_done(self: Coordinator) -> int:
+        return len(self.results)
+
+class CoordinatorManager(BaseManager):
+    pass
+
+# One server per process; later runs swap in their own coordinator
+_current: Coordinator = None
+_serving: bool = False
+
+def serve(coordinator: Coordinator, host: str, port: int, authkey: bytes) -> None:
+    """Serve the coordinator from a background thread of this process."""
+    global _current, _serving
+    _current = coordinator
+    if _serving:
+        return
+
+    CoordinatorManager.register('coordinator', callable=lambda: _current)
+    manager = CoordinatorManager(address=(host, port), authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _serving = True
+
+def work(host: str, port: int, authkey: bytes, poll: float=2.0, tables: tuple[str, str]=None) -> None:
+    CoordinatorManager.register('coordinator')
+    manager = CoordinatorManager(address=(host, port), authkey=authkey)
+    manager.connect()
+    coordinator = manager.coordinator()
+
+    if tables is not None:
+        kind, params = coordinator.get_params()
+        workers.init_tables(*tables, params['threshold'], params['n'])
+        find_range = workers.find_album_candidates_range if kind == KIND_ALBUMS else workers.find_escapees_range
+        find = lambda span: find_range(*span)
+    else:
+        kind, pool, params = coordinator.get_job()
+        workers.init_pool(pool, params['threshold'], params['n'])
+        find = workers.find_album_candidates if kind == KIND_ALBUMS else workers.find_escapees
+
+    while True:
+        unit_id, items = coordinator.lease(tables is not None)
+        if unit_id == -1:
+            break
+        elif unit_id is None:
+            time.sleep(poll) # Everything is leased out; wait in case a lease expires
+            continue
+
+        result, _ = find(items)
+        coordinator.complete(unit_id, result)
+
+def start_local(n: int, host: str, port: int, authkey: bytes, tables: tuple[str, str]=None) -> list[multiprocessing.Process]:
+    """Local processes standing in for workers on other hosts, mapping tables (old, new) if given."""
+    procs = []
+    for _ in range(n):
+        proc = multiprocessing.Process(target=work, args=(host, port, authkey, 2.0, tables), daemon=True)
+        proc.start()
+        procs.append(proc)
+    return procs
+
+if __name__ == '__main__':
+    # python src/distributed.py HOST PORT AUTHKEY
+    host, port, authkey = sys.argv[1], int(sys.argv[2]), sys.argv[3].encode()
+    work(host, port, authkey)
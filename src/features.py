@@ -0,0 +1,93 @@
+from __future__ import annotations
+from array import array
+from pathlib import Path
+from columnar import Sections, decode_fields, write_sections, _encode
+from library import Album, Track
+import matching
+
+# Track or album features for process pools, written once to a file that every
+# worker maps. The pages are shared through the OS rather than copied into each
+# worker, and tasks name rows by index rather than carrying tracks or albums.
+#
+#   magic, header length, header (JSON: kind, n_rows, fields, set_fields, sections)
+#   strings.offsets, strings.blob
+#   rows.path, rows.ts_seen
+#   rows.<field>.kind, rows.<field>.value for each field in weights but the sets
+#   rows.<field>.offsets, rows.<field>.ids for each set field (of strings)
+
+MAGIC = b'MIFT0002'
+
+KINDS = {'Track': Track, 'Album': Album}
+
+def save(items: list[matching.Matchable], path: Path, cls: type=Track) -> None:
+    strings = {}
+
+    def _sid(s: str) -> int:
+        if s is None:
+            return -1
+        return strings.setdefault(s, len(strings))
+
+    set_fields = [field for field in cls.weights if cls.kinds.get(field) is set]
+    cols = {'rows.path': array('q'), 'rows.ts_seen': array('q')}
+    for field in cls.weights:
+        if field in set_fields:
+            cols[f'rows.{field}.offsets'] = array('q', [0])
+            cols[f'rows.{field}.ids'] = array('q')
+        else:
+            cols[f'rows.{field}.kind'] = array('b')
+            cols[f'rows.{field}.value'] = array('d')
+
+    for m in items:
+        cols['rows.path'].append(_sid(str(m.path)))
+        cols['rows.ts_seen'].append(m.ts_seen)
+        for field in cls.weights:
+            v = m.data.get(field)
+            if field in set_fields:
+                ids = cols[f'rows.{field}.ids']
+                ids.extend(_sid(s) for s in sorted(v or ()))
+                cols[f'rows.{field}.offsets'].append(len(ids))
+            else:
+                kind, value = _encode(v, _sid)
+                cols[f'rows.{field}.kind'].append(kind)
+                cols[f'rows.{field}.value'].append(value)
+
+    blobs = [s.encode('utf-8', 'surrogateescape') for s in strings]
+    offsets = array('q', [0])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+
+    sections = {'strings.offsets': offsets, 'strings.blob': b''.join(blobs)}
+    sections.update(cols)
+    header = {'kind': cls.__name__, 'n_rows': len(items), 'fields': list(cls.weights), 'set_fields': set_fields}
+    write_sections(path, MAGIC, header, sections)
+
+class FeatureTable(Sections):
+    """A saved table, mapped. Rows become Tracks or Albums (without tracks) only while they are scored."""
+
+    def __init__(self: FeatureTable, path: Path) -> None:
+        super().__init__(path, MAGIC)
+        self.cls = KINDS[self.header['kind']]
+        self.set_fields = self.header['set_fields']
+        self.fields = [field for field in self.header['fields'] if field not in self.set_fields]
+
+    def __len__(self: FeatureTable) -> int:
+        return self.header['n_rows']
+
+    def key(self: FeatureTable, i: int) -> str:
+        return self.string(self.cols['rows.path'][i])
+
+    def ts_seen(self: FeatureTable, i: int) -> int:
+        return self.cols['rows.ts_seen'][i]
+
+    def row(self: FeatureTable, i: int) -> matching.Matchable:
+        data = decode_fields(self, self.fields, i, 'rows')
+        for field in self.set_fields:
+            offsets, ids = self.cols[f'rows.{field}.offsets'], self.cols[f'rows.{field}.ids']
+            data[field] = set(self.string(ids[k]) for k in range(offsets[i], offsets[i + 1]))
+
+        if self.cls is Track:
+            return Track(Path(self.key(i)), data, ts=self.ts_seen(i))
+
+        a = Album(Path(self.key(i)), self.ts_seen(i))
+        a.data.update(data)
+        return a
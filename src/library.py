@@ -1,36 +1,143 @@
 from __future__ import annotations
+from array import array
+from collections.abc import Iterable, Mapping
 from pathlib import Path
-from tinytag import TinyTag
 from matching import Matchable
+import hashlib
+import math
+import time
 import tools
-import progressbar
 from functools import total_ordering
+from numbers import Number
+
+# tinytag and progressbar are imported where they are used, so that
+# programs which never scan don't pay for them at startup
 
 EXTS = ['mp3', 'flac', 'wav', 'm4a']
+HEADER_DURATION_EXTS = ['flac', 'wav'] # Formats that state their duration up front
+MAX_TAG_BYTES = 512 * 1024 # Most a fast scan reads from any one file
+
+_tags: TagCache = None # Where durations read after a fast scan are kept; see use_tag_cache
+
+def use_tag_cache(tags: TagCache) -> None:
+    global _tags
+    _tags = tags
+
+def save_tag_cache() -> None:
+    if _tags is not None:
+        _tags.save()
 
 class Library:
+    """A library spanning one or more roots. Each root is scanned and cached on its own."""
+    roots: list[LibraryRoot]
+    tracks: Merged
+    albums: Merged
+
+    def __init__(self: Library, roots: list[LibraryRoot]) -> None:
+        self.roots = roots
+        self.merge()
+
+    def merge(self: Library) -> None:
+        self.tracks = Merged([root.tracks for root in self.roots])
+        self.albums = Merged([root.albums for root in self.roots])
+
+    def root_of(self: Library, path: Path) -> LibraryRoot:
+        for root in self.roots:
+            if path.is_relative_to(root.path_base):
+                return root
+        raise ValueError(f'{path} is not under any root of this library')
+
+class Merged(Mapping):
+    """Read-only view over the tracks or albums of several roots, without copying them."""
+    maps: list[Mapping]
+
+    def __init__(self: Merged, maps: list[Mapping]) -> None:
+        self.maps = maps
+
+    def __contains__(self: Merged, key: object) -> bool:
+        return any(key in m for m in self.maps)
+
+    def __getitem__(self: Merged, key: object) -> object:
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        raise KeyError(key)
+
+    def __iter__(self: Merged):
+        for m in self.maps:
+            yield from m
+
+    def __len__(self: Merged) -> int:
+        return sum(len(m) for m in self.maps)
+
+    def copy(self: Merged) -> dict:
+        return dict(self)
+
+class LibraryRoot:
     path_base: Path
     tracks: dict[str, Track]
-    albums: dict[str, Album]
+    albums: dict[Path, Album]
+    moves: dict[str, str] # Old path to new path, for tracks and albums, until consumed
 
-    def __init__(self: Library, path_base: Path) -> None:
+    def __init__(self: LibraryRoot, path_base: Path) -> None:
         self.path_base = path_base
         self.tracks = {}
         self.albums = {}
-    
-    def scan(self: Library) -> None:
-        existing = set(t.path for t in self.tracks.values())
+        self.moves = {}
+
+    @staticmethod
+    def adopt(legacy: object) -> LibraryRoot:
+        """Rehouse the tracks of a pickled single-root Library."""
+        root = LibraryRoot(legacy.path_base)
+        root.tracks = legacy.tracks
+        root.albums = legacy.albums
+
+        # Older scans never linked tracks back to their albums
+        for a in root.albums.values():
+            for t in a.tracks.values():
+                t.album = a
+
+        return root
+
+    def scan(self: LibraryRoot, verbose: bool=True, tags: TagCache=None, fast: bool=False, concurrency: int=1, physical: bool=False) -> bool:
+        """
+        Bring the root up to date with the disk. Return True if anything changed.
+        With concurrency above 1, that many listings and reads are kept in flight,
+        which pays off on network shares where every stat and open has to wait.
+        Physical orders reads by disk block rather than inode; see tools.order_for_disk.
+        """
+        existing = set(Path(key) for key in self.tracks)
         
-        filepaths = tools.get_filepaths(self.path_base, exts=EXTS)
+        if concurrency > 1:
+            filepaths = tools.get_filepaths_concurrent(self.path_base, exts=EXTS, concurrency=concurrency)
+        else:
+            filepaths = tools.get_filepaths(self.path_base, exts=EXTS)
         new = filepaths.difference(existing)
         deleted = existing.difference(filepaths)
 
+        return self.update(new, deleted, verbose=verbose, tags=tags, fast=fast, concurrency=concurrency, physical=physical)
+
+    def update(self: LibraryRoot, new: set[Path], deleted: set[Path], verbose: bool=True, tags: TagCache=None, fast: bool=False, concurrency: int=1, physical: bool=False) -> bool:
+        """Forget the deleted paths and memorize the new ones. Return True if anything changed."""
         ts = tools.ts_now()
 
+        moved = self.find_moves(new, deleted)
+        if moved:
+            if verbose:
+                print(f'Relocating moved tracks: {len(moved)}')
+
+            self.relocate(moved)
+            new = new.difference(moved.values())
+            deleted = deleted.difference(moved)
+
+        if verbose and (deleted or new):
+            import progressbar
+
         if deleted:
-            print(f'Forgetting deleted tracks: {len(deleted)}')
+            if verbose:
+                print(f'Forgetting deleted tracks: {len(deleted)}')
 
-            bar = progressbar.ProgressBar()
+            bar = progressbar.ProgressBar() if verbose else iter
             for path in bar(deleted):
                 key = str(path)
 
@@ -42,28 +149,276 @@ class Library:
                 a = t.album
                 del a.tracks[key]
                 if not a.tracks:
-                    del self.albums[str(a.path)]
+                    del self.albums[a.path]
+                else:
+                    a.rebuild_data()
+                    a.ts_seen = ts
 
         if new:
-            print(f'Memorizing new tracks: {len(new)}')
-
-            bar = progressbar.ProgressBar()
-            for path in bar(new):
+            # Read folder by folder in disk order, so a cold disk seeks forward rather than back and forth
+            batches = tools.order_for_disk(new, physical)
+            if verbose:
+                print(f'Memorizing new tracks: {len(new)} in {len(batches)} folders')
+
+            # Within a throttle (see tools.Throttle), every file and byte read counts against its limits
+            def read(path: Path) -> Track:
+                tools.take_file()
+                return Track.from_path(path, ts=ts, tags=tags, fast=fast)
+
+            ts_read = time.monotonic()
+            if concurrency > 1:
+                # Several folders side by side, each read in order; then file them in below as usual
+                bar = tools.make_io_bar(len(batches)) if verbose else None
+                read_batch = lambda batch: [(path, read(path)) for path in batch]
+                done = tools.map_concurrent(read_batch, [tuple(batch) for batch in batches], concurrency, bar.update if verbose else None)
+                made = [pair for batch in batches for pair in done[tuple(batch)]]
+                if verbose:
+                    bar.finish()
+            else:
+                ordered = [path for batch in batches for path in batch]
+                bar = tools.make_io_bar(len(ordered)) if verbose else iter
+                made = ((path, read(path)) for path in bar(ordered))
+
+            n_bytes = 0
+            for (path, t) in made:
+                n_bytes += t.size or 0
                 key = str(path) 
-
-                t = Track.from_path(path, ts=ts)
                 self.tracks[key] = t
 
                 par = path.parent
                 a = self.albums.setdefault(par, Album(par, ts))
 
+                t.album = a
                 a.tracks[key] = t
                 a.update_data(t)
 
+                # An album that changed may now match where it didn't before
+                a.ts_seen = ts
+
+            if verbose:
+                secs = max(time.monotonic() - ts_read, 1e-6)
+                print(f'Read {len(new)} tracks ({tools.format_bytes(n_bytes)}) in {secs:.1f} s: {len(new) / secs:.0f} tracks/s, {tools.format_bytes(n_bytes / secs)}/s')
+
+        return bool(new or deleted or moved)
+
+    def find_moves(self: LibraryRoot, new: set[Path], deleted: set[Path]) -> dict[Path, Path]:
+        """Pair deleted tracks with new files that have the same size, mtime and content hash."""
+        if not (new and deleted):
+            return {}
+
+        gone = {}
+        for path in deleted:
+            t = self.tracks[str(path)]
+            if getattr(t, 'digest', None) is not None:
+                gone.setdefault((t.size, t.mtime), []).append(t)
+
+        moved = {}
+        for path in new:
+            stat = path.stat()
+            candidates = gone.get((stat.st_size, stat.st_mtime_ns))
+            if not candidates:
+                continue
+
+            # Only hash files that could be a match
+            digest = tools.digest_file(path)
+            for t in candidates:
+                if t.digest == digest:
+                    moved[t.path] = path
+                    candidates.remove(t)
+                    break
+
+        return moved
+
+    def relocate(self: LibraryRoot, moved: dict[Path, Path]) -> None:
+        """Move Track objects (and whole Albums, where they moved together) without rereading tags."""
+        ts = tools.ts_now()
+        by_album = {}
+        for (src, dest) in moved.items():
+            t = self.tracks[str(src)]
+            by_album.setdefault(t.album, {})[src] = dest
+
+        for (a, pairs) in by_album.items():
+            dests = set(dest.parent for dest in pairs.values())
+            par = dests.pop() if len(dests) == 1 else None
+
+            # The whole folder moved somewhere new: carry the Album along
+            if (par is not None) and (len(pairs) == len(a.tracks)) and (par not in self.albums):
+                del self.albums[a.path]
+                self.moves[str(a.path)] = str(par)
+                a.path = par
+                a.data['folder_name'] = par.name
+                self.albums[par] = a
+
+                a.tracks = {}
+                for (src, dest) in pairs.items():
+                    t = self.move_track(src, dest)
+                    a.tracks[str(dest)] = t
+                continue
+
+            for (src, dest) in pairs.items():
+                t = self.move_track(src, dest)
+                del a.tracks[str(src)]
+
+                b = self.albums.setdefault(dest.parent, Album(dest.parent, t.ts_seen))
+                t.album = b
+                b.tracks[str(dest)] = t
+                b.update_data(t)
+                b.ts_seen = ts
+
+            if not a.tracks:
+                del self.albums[a.path]
+            else:
+                a.rebuild_data()
+                a.ts_seen = ts
+
+    def move_track(self: LibraryRoot, src: Path, dest: Path) -> Track:
+        t = self.tracks.pop(str(src))
+        self.moves[str(src)] = str(dest)
+        t.path = dest
+        t.data['filename'] = tools.normalize_title(dest.stem)
+        self.tracks[str(dest)] = t
+        return t
+
+    def take_moves(self: LibraryRoot) -> dict[str, str]:
+        moves, self.moves = self.moves, {}
+        return moves
+
+class TagCache:
+    """
+    Raw tags by (size, mtime, content hash), shared by both libraries and
+    kept apart from their caches, so no copy of a file is parsed twice.
+    """
+    path: Path
+    entries: dict[tuple[int, int, str], dict[str, object]]
+    dirty: bool
+
+    def __init__(self: TagCache, path: Path) -> None:
+        self.path = path
+        self.entries = tools._unpickle(path, {})
+        self.dirty = False
+
+    def get(self: TagCache, key: tuple[int, int, str]) -> dict[str, object]:
+        return self.entries.get(key)
+
+    def put(self: TagCache, key: tuple[int, int, str], tags: dict[str, object]) -> None:
+        self.entries[key] = tags
+        self.dirty = True
+
+    def prune(self: TagCache, tracks: Iterable[Track]) -> None:
+        """Forget the files none of these tracks are, such as versions since rewritten."""
+        keep = set((t.size, t.mtime, t.digest) for t in tracks)
+        gone = [key for key in self.entries if key not in keep]
+        for key in gone:
+            del self.entries[key]
+        self.dirty |= bool(gone)
+
+    def save(self: TagCache) -> None:
+        if self.dirty:
+            tools._pickle(self.entries, self.path)
+            self.dirty = False
+
+class AlignmentCache:
+    """
+    Track alignments of album pairs, by their paths and a stamp of the settings
+    that produced them. Each entry carries the versions of both albums, so a
+    rescan that changes either retires it.
+    """
+    path: Path
+    settings: str
+    entries: dict[tuple[str, str, str], tuple[str, str, list[tuple[str, str, float, bool]]]]
+    dirty: bool
+
+    def __init__(self: AlignmentCache, path: Path, settings: str) -> None:
+        self.path = path
+        self.settings = settings
+        entries = tools._unpickle(path, {})
+
+        # Alignments under other weights or thresholds would never be looked up again
+        self.entries = {key: entry for (key, entry) in entries.items() if (len(key) == 3) and (key[0] == settings)}
+        self.dirty = len(self.entries) != len(entries)
+
+    def get(self: AlignmentCache, a: Album, b: Album) -> list[tuple[str, str, float, bool]]:
+        """(track key, best key, score, satisfied) for each track of a, or None."""
+        entry = self.entries.get((self.settings, str(a.path), str(b.path)))
+        if (entry is None) or (entry[0] != a.version()) or (entry[1] != b.version()):
+            return None
+        return entry[2]
+
+    def put(self: AlignmentCache, a: Album, b: Album, pairs: list[tuple[str, str, float, bool]]) -> None:
+        self.entries[(self.settings, str(a.path), str(b.path))] = (a.version(), b.version(), pairs)
+        self.dirty = True
+
+    def prune(self: AlignmentCache, albums_a: Mapping, albums_b: Mapping) -> None:
+        """Forget pairs either of whose albums is gone."""
+        gone = [key for key in self.entries if (Path(key[1]) not in albums_a) or (Path(key[2]) not in albums_b)]
+        for key in gone:
+            del self.entries[key]
+        self.dirty |= bool(gone)
+
+    def save(self: AlignmentCache) -> None:
+        if self.dirty:
+            # A copy, since reviews align the next albums in the background
+            tools._pickle(self.entries.copy(), self.path)
+            self.dirty = False
+
+class SimilarityCache:
+    """
+    Unweighted per-field similarities of scored pairs, so they can be weighed
+    again under other weights without comparing anything. Stored as floats,
+    four bytes a field, NaN for missing; each entry carries both sides' ts_seen,
+    which changes whenever either is re-read.
+    """
+    path: Path
+    fields: dict[str, tuple[str]] # Field order by kind (Album, Track)
+    pairs: dict[tuple[str, str, str], tuple[int, int, bytes]] # (kind, path, path): ts_seen, ts_seen, measures
+    dirty: bool
+
+    def __init__(self: SimilarityCache, path: Path) -> None:
+        self.path = path
+        self.fields, self.pairs = tools._unpickle(path, ({}, {}))
+        self.dirty = False
+
+    @staticmethod
+    def decode(measures: bytes) -> tuple[float]:
+        return tuple(None if math.isnan(n) else n for n in array('f', measures))
+
+    def get(self: SimilarityCache, m1: Matchable, m2: Matchable) -> tuple[float]:
+        kind = type(m1).__name__
+        entry = self.pairs.get((kind, str(m1.path), str(m2.path)))
+        if (entry is None) or (entry[:2] != (m1.ts_seen, m2.ts_seen)) or (self.fields.get(kind) != tuple(m1.weights)):
+            return None
+        return self.decode(entry[2])
+
+    @staticmethod
+    def encode(m1: Matchable, m2: Matchable, raw: tuple[float]) -> tuple[str, str, str, tuple[int, int, bytes]]:
+        """A pair as it is stored, for put_encoded."""
+        measures = array('f', (math.nan if n is None else n for n in raw)).tobytes()
+        return (type(m1).__name__, str(m1.path), str(m2.path)), (m1.ts_seen, m2.ts_seen, measures)
+
+    def put(self: SimilarityCache, m1: Matchable, m2: Matchable, raw: tuple[float]) -> None:
+        self.put_encoded(tuple(m1.weights), *self.encode(m1, m2, raw))
+
+    def put_encoded(self: SimilarityCache, fields: tuple[str], key: tuple[str, str, str], entry: tuple[int, int, bytes]) -> None:
+        kind = key[0]
+
+        # A schema with other fields makes every stored measure of that kind meaningless
+        if self.fields.get(kind) != fields:
+            self.pairs = {k: v for (k, v) in self.pairs.items() if k[0] != kind}
+            self.fields[kind] = fields
+
+        self.pairs[key] = entry
+        self.dirty = True
+
+    def save(self: SimilarityCache) -> None:
+        if self.dirty:
+            tools._pickle((self.fields, self.pairs), self.path)
+            self.dirty = False
+
 @total_ordering
 class Album(Matchable):
     path: Path
     tracks: dict[str, Track]
+    ts_seen: int # When the album appeared or last changed
     weights = {
         'folder_name': 6,
         'n_tracks': 2,
@@ -71,6 +426,13 @@ class Album(Matchable):
         'artists': 4,
         'duration': 6
     }
+    kinds = {
+        'folder_name': str,
+        'n_tracks': Number,
+        'albumartists': set, # Of str
+        'artists': set,
+        'duration': Number
+    }
 
     def __init__(self: Album, path: Path, ts: int=0) -> None:
         self.path = path
@@ -89,13 +451,42 @@ class Album(Matchable):
         self.data['artists'] = set()
         self.data['albumartists'] = set()
 
+    def rebuild_data(self: Album) -> None:
+        self.set_default_data()
+        for t in self.tracks.values():
+            self.update_data(t)
+
     def update_data(self: Album, t: Track) -> None:
         self.data['n_tracks'] += 1
         if t.data['artist'] is not None:
             self.data['artists'].add(t.data['artist'])
         if t.data['albumartist'] is not None:
             self.data['albumartists'].add(t.data['albumartist'])
-        self.data['duration'] += t.data['duration']
+
+        # One track of unknown length makes the album's length unknown
+        if (self.data['duration'] is None) or (t.data['duration'] is None):
+            self.data['duration'] = None
+        else:
+            self.data['duration'] += t.data['duration']
+
+    def fill(self: Album) -> None:
+        # Only an album of unknown length can have tracks waiting on theirs
+        if self.data['duration'] is not None:
+            return
+
+        deferred = [t for t in self.tracks.values() if getattr(t, 'duration_deferred', False)]
+        for t in deferred:
+            t.ensure_duration(rebuild=False)
+        if deferred:
+            self.rebuild_data()
+
+    def version(self: Album) -> str:
+        """Changes whenever a track is added, removed or rewritten."""
+        h = hashlib.blake2b(digest_size=8)
+        for key in sorted(self.tracks):
+            t = self.tracks[key]
+            h.update(f'{key}|{getattr(t, "size", None)}|{getattr(t, "mtime", None)}|{getattr(t, "digest", None)}\n'.encode())
+        return h.hexdigest()
 
     def present(self: Album) -> str:
         artist = sorted(self.data['albumartists'])[0]
@@ -123,6 +514,9 @@ class Album(Matchable):
 class Track(Matchable):
     path: Path
     album: Album
+    size: int
+    mtime: int
+    digest: str
     weights = {
         'filename': 5,
         'albumname': 6,
@@ -134,11 +528,24 @@ class Track(Matchable):
         'genre': 1,
         'duration': 5
     }
+    kinds = {
+        'filename': str,
+        'albumname': str,
+        'title': str,
+        'artist': str,
+        'albumartist': str,
+        'composer': str,
+        'genre': str,
+        'duration': Number
+        # track is an int or a str, depending on the tag reader
+    }
 
     def __init__(self: Track, path: Path, data: dict[str, str], ts: int=0) -> None:
         self.path = path
         self.album = None # Gets set at album creation
         self.ts_seen = ts
+        self.size, self.mtime, self.digest = None, None, None # Gets set when read from disk
+        self.duration_deferred = False
         self.set_default_data()
         self.set_data(data)
 
@@ -152,19 +559,24 @@ class Track(Matchable):
             self.data[k] = v
 
     @staticmethod
-    def from_path(path: Path, fill_gaps: bool=True, ts: int=0) -> Track:
-        tags = TinyTag.get(path)
+    def from_path(path: Path, fill_gaps: bool=True, ts: int=0, tags: TagCache=None, fast: bool=False) -> Track:
+        # Enough to recognize the file if it moves, or if a copy turns up
+        stat = path.stat()
+        digest = tools.digest_file(path)
+        key = (stat.st_size, stat.st_mtime_ns, digest)
 
-        data = {
-            'albumname': tags.album,
-            'title': tags.title,
-            'artist': tags.artist,
-            'albumartist': tags.albumartist,
-            'track': tags.track,
-            'composer': tags.composer,
-            'genre': tags.genre,
-            'duration': tags.duration
-        }
+        raw = tags.get(key) if tags is not None else None
+        if raw is None:
+            raw = Track.read_tags(path, fast)
+            if tags is not None:
+                tags.put(key, raw)
+
+        elif raw.get('duration_deferred') and (not fast):
+            raw = dict(raw, duration=Track.read_duration(path), duration_deferred=False)
+            tags.put(key, raw)
+
+        data = dict(raw)
+        deferred = data.pop('duration_deferred', False)
 
         if fill_gaps and (data['albumartist'] is None) and (data['artist'] is not None):
             data['albumartist'] = data['artist']
@@ -175,7 +587,84 @@ class Track(Matchable):
             if isinstance(data[k], str):
                 data[k] = tools.normalize_title(v)
 
-        return Track(path, data, ts=ts)
+        t = Track(path, data, ts=ts)
+        t.size, t.mtime, t.digest = key
+        t.duration_deferred = deferred
+        return t
+
+    @staticmethod
+    def read_tags(path: Path, fast: bool=False) -> dict[str, object]:
+        """
+        Read the tags we match on. In fast mode, read at most MAX_TAG_BYTES,
+        and leave the duration for later unless the header has it.
+        """
+        from tinytag import TinyTag
+
+        duration = True
+        if not fast:
+            with tools.open_metered(path) as f:
+                tags = TinyTag.get(path, file_obj=f)
+        else:
+            duration = path.suffix.strip('.').lower() in HEADER_DURATION_EXTS
+            tags, reader = None, None
+            try:
+                with tools.open_metered(path) as f:
+                    reader = tools.BoundedReader(f, MAX_TAG_BYTES)
+                    tags = TinyTag.get(path, file_obj=reader, duration=duration)
+            except Exception:
+                pass
+
+            # Tags past the cap (behind a large embedded image, an ID3v1 tag at the
+            # end, an m4a with moov last) mostly come back empty rather than failing,
+            # so read the whole file whenever the cap was reached or nothing was found
+            if (tags is None) or (reader.remaining <= 0) or not (tags.title or tags.artist or tags.album):
+                with tools.open_metered(path) as f:
+                    tags = TinyTag.get(path, file_obj=f, duration=duration)
+
+        return {
+            'albumname': tags.album,
+            'title': tags.title,
+            'artist': tags.artist,
+            'albumartist': tags.albumartist,
+            'track': tags.track,
+            'composer': tags.composer,
+            'genre': tags.genre,
+            'duration': tags.duration if duration else None,
+            'duration_deferred': not duration
+        }
+
+    @staticmethod
+    def read_duration(path: Path) -> float:
+        from tinytag import TinyTag
+        with tools.open_metered(path) as f:
+            return TinyTag.get(path, file_obj=f, tags=False, duration=True).duration
+
+    def ensure_duration(self: Track, rebuild: bool=True) -> None:
+        """Read the exact duration if a fast scan left it out, and keep it in the tag cache."""
+        if (self.data['duration'] is not None) or (not getattr(self, 'duration_deferred', False)):
+            return
+
+        self.duration_deferred = False
+
+        # Read on an earlier run if the tag cache has it, though the library cache may not
+        key = (self.size, self.mtime, self.digest)
+        raw = _tags.get(key) if _tags is not None else None
+        if (raw is not None) and (not raw.get('duration_deferred')):
+            self.data['duration'] = raw['duration']
+        else:
+            try:
+                self.data['duration'] = Track.read_duration(self.path)
+            except Exception as e:
+                print(f'Could not read the duration of {self.path}: {e}')
+                return
+            if raw is not None:
+                _tags.put(key, dict(raw, duration=self.data['duration'], duration_deferred=False))
+
+        if rebuild and (self.album is not None):
+            self.album.rebuild_data()
+
+    def fill(self: Track) -> None:
+        self.ensure_duration()
     
     def present(self: Track) -> str:
         return f'{self.data['albumartist']} : {self.path.stem}'
@@ -1,15 +1,25 @@
 from __future__ import annotations
 from pathlib import Path
-from library import Album, Library, Track, EXTS
+from library import AlignmentCache, Album, Library, LibraryRoot, SimilarityCache, TagCache, Track, EXTS
+import library
 import matching
 import prompts
 import os
 import shutil
 from tools import _pickle, _unpickle
 import tools
-from tabulate import tabulate
 import re
-import progressbar
+import sys
+import hashlib
+import secrets
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import watch
+from prefetch import Prefetcher
+
+# Heavier modules (tabulate, progressbar, multiprocessing and our modules built on it)
+# are imported by the programs that use them, so quick programs start quickly
 
 # God app :')
 
@@ -21,18 +31,47 @@ class App:
     THRESHOLD_POSSIBLE: float = 0.65
     FAST_BATCH_SIZE: int = 40
     ALBUM_NAME_LENGTH: int = 60
+    PREFETCH_DEPTH: int = 3 # Albums to work out ahead of the one under review
+    UNIT_SIZE: int = 20 # Albums or tracks per unit of distributed work
+    LEASE_TIMEOUT: float = 600.0 # Seconds before a unit given to a silent worker is handed out again
+    WATCH_SETTLE: float = 2.0 # Seconds of quiet before a burst of events is applied
+    WATCH_STALE: float = 60.0 # Seconds after which a silent watcher is presumed dead
+    ESCAPEE_CHUNK_SIZE: int = 25
+    CHECKPOINT_INTERVAL: float = 60.0 # Seconds between saves of a long search
+    REVIEW_LEASE_TIMEOUT: float = 1_800.0 # Seconds an unreviewed album stays with a reviewer who went quiet
+    REVIEW_BATCH_SIZE: int = 20 # Albums leased at a time
+    STREAM_CHUNK_SIZE: int = 200 # Albums matched between checks on memory
+    STREAM_CANDIDATES: int = 50 # New albums scored per old album, those sharing most artists and words
 
     PATH_CONFIG: Path = Path('src/config.ini')
 
     RE_UNKNOWN = r'Y|N|E|Q|S'
-    RE_UNMATCHED = r'(N)|(M \d+)|(E \d+)|(Q)|(S)'
+    RE_UNMATCHED = r'(N)|(M \d+)|(E \d+)|(F .+)|(Q)|(S)'
     RE_COMPARE = r'K|R|M|X|N'
     
     # Configurables
-    PATH_LIB_OLD: Path
-    PATH_LIB_NEW: Path
+    PATHS_LIB_OLD: list[Path]
+    PATHS_LIB_NEW: list[Path]
     PATH_LIB_CULL: Path
     PATH_PICKLES: Path
+    CACHE_FORMAT: str = 'pickle' # Or 'columnar', for memory-mapped caches that load lazily
+    FAST_TAGS: bool = False # Read only tag headers when scanning; see Track.read_tags
+    N_WORKERS: int = os.cpu_count() or 1
+    SCAN_CONCURRENCY: int = 1 # Listings and tag reads in flight per root; raise for network shares
+    SCAN_CONCURRENCY_ROOTS: dict[Path, int] # Per-root overrides, from a third field on BASE_OLD/BASE_NEW
+    SCAN_PHYSICAL_ORDER: bool = False # Order tag reads by disk block (Linux FIEMAP) rather than inode; costs an open per file
+    SCAN_BYTES_PER_SEC: int = 0 # Read limits for scans, shared by all roots and threads; 0 for none
+    SCAN_FILES_PER_SEC: float = 0
+    CULL_BYTES_PER_SEC: int = 0 # The same for copies into the cull
+    CULL_FILES_PER_SEC: float = 0
+    IO_PRIORITY: str = None # ionice class for scans and the cull: realtime, best-effort or idle
+    COORDINATOR: tuple[str, int] = ('localhost', 50_505) # Address workers connect to; '' listens on all interfaces
+    AUTHKEY: bytes = None # Required to serve other machines; otherwise a random one is made for the run
+    # Streaming drops built albums above MEMORY_LIMIT_MB and spills its results to disk as it goes. Still
+    # held in full: any root a scan finds changed (while load_root updates it), the keys of decided albums,
+    # and, once matching is done, the stored candidates and similarities the results are merged into.
+    MEMORY_LIMIT_MB: int = 1_024 # See stream_album_matching
+    REVIEWER: str = f'{socket.gethostname()}:{os.getpid()}' # Names this session's leases; give each person their own
 
     PATH_PICKLE_LIB_OLD: Path
     PATH_PICKLE_LIB_NEW: Path
@@ -40,21 +79,71 @@ class App:
     PATH_PICKLE_DECISIONS_BACKUP: Path
 
     PATH_PICKLE_ESCAPEES: Path
+    PATH_PICKLE_ESCAPEES_CHECKPOINT: Path
+    PATH_PICKLE_ESCAPEES_SEEN: Path
+    PATH_PICKLE_CANDIDATES: Path
+    PATH_PICKLE_TAGS: Path
+    PATH_PICKLE_SEARCH: Path
+    PATH_PICKLE_ALIGNMENTS: Path
+    PATH_PICKLE_LEASES: Path
+    PATH_DECISIONS_LOCK: Path
+    PATH_CANDIDATE_INDEX: Path
+    PATH_PICKLE_SIMILARITIES: Path
+    PATH_WATCH_HEARTBEAT: Path
+    PATH_FEATURES_OLD: Path
+    PATH_FEATURES_NEW: Path
 
     def load_configuration(self: App) -> None:
+        self.PATHS_LIB_OLD = []
+        self.PATHS_LIB_NEW = []
+        self.SCAN_CONCURRENCY_ROOTS = {}
 
         with open(self.PATH_CONFIG, 'r') as f:
             for line in f.readlines():
-                k, v = (c.strip() for c in line.split('::'))
-
-                if k == 'BASE_OLD':
-                    self.PATH_LIB_OLD = Path(v)
-                elif k == 'BASE_NEW':
-                    self.PATH_LIB_NEW = Path(v)
+                k, v, *rest = (c.strip() for c in line.split('::'))
+
+                # BASE_OLD and BASE_NEW may be given once per root, optionally
+                # with the scan concurrency for that root, e.g. BASE_OLD :: /mnt/share :: 32
+                if k in ('BASE_OLD', 'BASE_NEW'):
+                    paths = self.PATHS_LIB_OLD if k == 'BASE_OLD' else self.PATHS_LIB_NEW
+                    paths.append(Path(v))
+                    if rest:
+                        self.SCAN_CONCURRENCY_ROOTS[Path(v)] = int(rest[0])
                 elif k == 'BASE_CULL':
                     self.PATH_LIB_CULL = Path(v)
                 elif k == 'BASE_PICKLES':
                     self.PATH_PICKLES = Path(v)
+                elif k == 'SCAN_CONCURRENCY':
+                    self.SCAN_CONCURRENCY = int(v)
+                elif k in ('SCAN_LIMIT', 'CULL_LIMIT'):
+                    # Bytes and, optionally, files a second, e.g. SCAN_LIMIT :: 20M :: 200
+                    n_bytes, n_files = tools.parse_size(v), float(rest[0]) if rest else 0
+                    if k == 'SCAN_LIMIT':
+                        self.SCAN_BYTES_PER_SEC, self.SCAN_FILES_PER_SEC = n_bytes, n_files
+                    else:
+                        self.CULL_BYTES_PER_SEC, self.CULL_FILES_PER_SEC = n_bytes, n_files
+                elif k == 'IO_PRIORITY':
+                    if v.lower() in tools.IO_CLASSES:
+                        self.IO_PRIORITY = v.lower()
+                    else:
+                        print(f'Unknown IO_PRIORITY {v}, ignoring it; use one of {", ".join(tools.IO_CLASSES)}')
+                elif k == 'SCAN_PHYSICAL_ORDER':
+                    self.SCAN_PHYSICAL_ORDER = v.lower() in ('y', 'yes', 'true', '1')
+                elif k == 'WORKERS':
+                    self.N_WORKERS = int(v)
+                elif k == 'CACHE_FORMAT':
+                    self.CACHE_FORMAT = v
+                elif k == 'FAST_TAGS':
+                    self.FAST_TAGS = v.lower() in ('y', 'yes', 'true', '1')
+                elif k == 'COORDINATOR':
+                    host, port = v.rsplit(':', 1)
+                    self.COORDINATOR = (host, int(port))
+                elif k == 'AUTHKEY':
+                    self.AUTHKEY = v.encode()
+                elif k == 'MEMORY_LIMIT':
+                    self.MEMORY_LIMIT_MB = int(v)
+                elif k == 'REVIEWER':
+                    self.REVIEWER = v
 
         if not Path.exists(self.PATH_PICKLES):
             Path.mkdir(self.PATH_PICKLES, exist_ok=True, parents=True)
@@ -65,69 +154,207 @@ class App:
         self.PATH_PICKLE_DECISIONS = Path(f'{self.PATH_PICKLES}/decisions.pickle')
         self.PATH_PICKLE_DECISIONS_BACKUP = Path(f'{self.PATH_PICKLES}/decisions_backup.pickle')
         self.PATH_PICKLE_ESCAPEES = Path(f'{self.PATH_PICKLES}/escapees.pickle')
+        self.PATH_PICKLE_ESCAPEES_CHECKPOINT = Path(f'{self.PATH_PICKLES}/escapees_checkpoint.pickle')
+        self.PATH_PICKLE_ESCAPEES_SEEN = Path(f'{self.PATH_PICKLES}/escapees_seen.pickle')
+        self.PATH_PICKLE_CANDIDATES = Path(f'{self.PATH_PICKLES}/candidates.pickle')
+        self.PATH_PICKLE_TAGS = Path(f'{self.PATH_PICKLES}/tags.pickle')
+        self.PATH_PICKLE_SEARCH = Path(f'{self.PATH_PICKLES}/search.pickle')
+        self.PATH_PICKLE_ALIGNMENTS = Path(f'{self.PATH_PICKLES}/alignments.pickle')
+        self.PATH_PICKLE_LEASES = Path(f'{self.PATH_PICKLES}/leases.pickle')
+        self.PATH_DECISIONS_LOCK = Path(f'{self.PATH_PICKLES}/decisions.lock')
+        self.PATH_CANDIDATE_INDEX = Path(f'{self.PATH_PICKLES}/lib_new.index')
+        self.PATH_PICKLE_SIMILARITIES = Path(f'{self.PATH_PICKLES}/similarities.pickle')
+        self.PATH_WATCH_HEARTBEAT = Path(f'{self.PATH_PICKLES}/watch.heartbeat')
+        self.PATH_FEATURES_OLD = Path(f'{self.PATH_PICKLES}/features_old.table')
+        self.PATH_FEATURES_NEW = Path(f'{self.PATH_PICKLES}/features_new.table')
+
+    def path_cache_root(self: App, name: str, path_base: Path, cache_format: str=None) -> Path:
+        """Each library root gets its own cache segment, e.g. lib_old_1a2b3c4d.pickle."""
+        cache_format = cache_format or self.CACHE_FORMAT
+        ext = 'columns' if cache_format == 'columnar' else 'pickle'
+        slug = hashlib.md5(str(path_base).encode()).hexdigest()[:8]
+        return Path(f'{self.PATH_PICKLES}/{name}_{slug}.{ext}')
 
 #  Functions
 
+def save_root(name: str, root: LibraryRoot) -> None:
+    path_cache = app.path_cache_root(name, root.path_base)
+    if app.CACHE_FORMAT == 'columnar':
+        import columnar
+        columnar.release(root)
+        columnar.save(root, path_cache)
+    else:
+        _pickle(root, path_cache)
+
+def load_root(name: str, path: Path, path_pickle_legacy: Path, verbose: bool=True, scan: bool=True, tags: TagCache=None) -> LibraryRoot:
+    if app.CACHE_FORMAT == 'columnar':
+        import columnar
+        root = columnar.load(app.path_cache_root(name, path))
+    else:
+        root = _unpickle(app.path_cache_root(name, path))
+    fresh = root is None
+
+    if fresh and (app.CACHE_FORMAT == 'columnar'):
+        # Switching formats: start from the pickled segment if there is one
+        root = _unpickle(app.path_cache_root(name, path, 'pickle'))
+
+    if root is None:
+        legacy = _unpickle(path_pickle_legacy)
+        if (legacy is not None) and (legacy.path_base == path):
+            root = LibraryRoot.adopt(legacy)
+        else:
+            root = LibraryRoot(path)
+
+    # Only roots that changed get their cache segment rewritten
+    concurrency = app.SCAN_CONCURRENCY_ROOTS.get(path, app.SCAN_CONCURRENCY)
+    if (scan or fresh) and (root.scan(verbose=verbose, tags=tags, fast=app.FAST_TAGS, concurrency=concurrency, physical=app.SCAN_PHYSICAL_ORDER) or fresh):
+        save_root(name, root)
+
+    if not verbose:
+        print(f'Scanned {path}: {len(root.tracks)} tracks')
+
+    return root
+
 def get_libraries() -> tuple[Library]:
 
-    def _get_library(path: Path, path_pickle: Path) -> Library:
-        lib = _unpickle(path_pickle, Library(path))
-        lib.scan()
-        _pickle(lib, path_pickle)
-        return lib
+    # A running watcher keeps the caches current, so there is nothing to walk
+    scan = not watch.is_watched(app.PATH_WATCH_HEARTBEAT, app.WATCH_STALE)
+    if not scan:
+        print('Libraries are being watched; skipping scan')
+
+    tags = TagCache(app.PATH_PICKLE_TAGS)
+
+    def _get_library(name: str, paths: list[Path], path_pickle_legacy: Path) -> Library:
+        if len(paths) == 1:
+            return Library([load_root(name, paths[0], path_pickle_legacy, True, scan, tags)])
+
+        # Scan roots side by side so that a slow share doesn't hold up the rest
+        with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+            futures = [pool.submit(load_root, name, path, path_pickle_legacy, False, scan, tags) for path in paths]
+            return Library([f.result() for f in futures])
     
-    print('Scanning old library...')
-    old = _get_library(app.PATH_LIB_OLD, app.PATH_PICKLE_LIB_OLD)
-    print('Scanning new library...')
-    new = _get_library(app.PATH_LIB_NEW, app.PATH_PICKLE_LIB_NEW)
+    with tools.IOPriority(app.IO_PRIORITY), tools.limit_io(app.SCAN_BYTES_PER_SEC, app.SCAN_FILES_PER_SEC) as throttle:
+        print('Scanning old library...')
+        old = _get_library('lib_old', app.PATHS_LIB_OLD, app.PATH_PICKLE_LIB_OLD)
+        print('Scanning new library...')
+        new = _get_library('lib_new', app.PATHS_LIB_NEW, app.PATH_PICKLE_LIB_NEW)
+
+    if throttle is not None:
+        print(f'Scans read at {throttle.report()}')
+
+    # Both libraries are here, so anything else in the cache is of files no longer around
+    tags.prune([*old.tracks.values(), *new.tracks.values()])
+    tags.save()
+    library.use_tag_cache(tags)
+
+    # Decisions refer to tracks and albums by key; these are where the keys are looked up
+    matching.use_libraries(old, new)
+    if _alignments is not None:
+        _alignments.prune(old.albums, new.albums)
+
+    # A watcher owns the caches while it runs, so leave its segments alone
+    relocate_decisions(old, new, forget_moves=scan)
 
     return old, new
 
+def relocate_decisions(old: Library, new: Library, forget_moves: bool=True) -> None:
+    """Point decisions and escapees at tracks and albums that moved since they were made."""
+    moves = {}
+    for root in old.roots + new.roots:
+        moves.update(root.moves)
+
+    if not moves:
+        return
+
+    print(f'Following {len(moves)} moved tracks and albums')
+
+    def _find(lib: Library, kind: str, key: str) -> matching.Matchable:
+        return lib.albums.get(Path(key)) if kind == matching.KIND_ALBUM else lib.tracks.get(key)
+
+    def _follow(key: str, lib: Library, kind: str=matching.KIND_TRACK) -> str:
+        # Something may have moved more than once since the last run, even back where
+        # it was; a key the library still has is where it belongs, whatever passed through it
+        seen = {key}
+        while (_find(lib, kind, key) is None) and (key in moves) and (moves[key] not in seen):
+            key = moves[key]
+            seen.add(key)
+        return key
+
+    def _current(m: matching.Matchable | matching.Ref, lib: Library) -> matching.Matchable | matching.Ref:
+        # Decisions find their tracks and albums in the libraries as they are
+        # now, so only those whose key moved away are left as references
+        if not isinstance(m, matching.Ref):
+            return m
+
+        key = _follow(m.key, lib, m.kind)
+        found = _find(lib, m.kind, key)
+        return found if found is not None else matching.Ref(m.kind, key)
+
+    # Reviewers merge into the same file, so rewrite it under their lock (see sessions.py)
+    with tools.FileLock(app.PATH_DECISIONS_LOCK):
+        decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
+        for dec in decs:
+            dec.old = _current(dec.old, old)
+            dec.new = _current(dec.new, new)
+
+            dec.omit = dict.fromkeys(_follow(key, old) for key in dec.omit)
+            dec.track_keys = [_follow(key, old) for key in dec.track_keys]
+
+        if decs:
+            _pickle(decs, app.PATH_PICKLE_DECISIONS)
+
+    bests = get_escapees()
+    if bests:
+        bests = {_follow(key, old): (_follow(key_best, new), score) for (key, (key_best, score)) in bests.items()}
+        _pickle(bests, app.PATH_PICKLE_ESCAPEES)
+
+    # A moved track was scored as it is, so it needn't be scored again in full
+    seen = _unpickle(app.PATH_PICKLE_ESCAPEES_SEEN, {})
+    if seen:
+        _pickle({_follow(key, old): ts for (key, ts) in seen.items()}, app.PATH_PICKLE_ESCAPEES_SEEN)
+
+    if not forget_moves:
+        return
+
+    # The moves are accounted for; don't follow them again
+    for (name, lib) in (('lib_old', old), ('lib_new', new)):
+        for root in lib.roots:
+            if root.take_moves():
+                save_root(name, root)
+
+def get_escapees() -> dict[str, tuple[str, float]]:
+    """Old track key: the key of its best new match, and the score."""
+    bests = _unpickle(app.PATH_PICKLE_ESCAPEES, {})
+
+    # Escapees saved before keys hold the new Track itself
+    return {key: (best if isinstance(best, str) else str(best.path), score) for (key, (best, score)) in bests.items()}
+
 def get_libraries_dev() -> tuple[Library]:
     '''Without pickling'''
 
-    def _get_library(path: Path) -> Library:
-        lib = Library(path)
-        lib.scan()
-        return lib
+    def _get_library(paths: list[Path]) -> Library:
+        roots = [LibraryRoot(path) for path in paths]
+        for root in roots:
+            root.scan()
+        return Library(roots)
 
     print('Scanning old library...')
-    old = _get_library(app.PATH_LIB_OLD)
+    old = _get_library(app.PATHS_LIB_OLD)
     print('Scanning new library...')
-    new = _get_library(app.PATH_LIB_NEW)
+    new = _get_library(app.PATHS_LIB_NEW)
 
     return old, new
 
 def find_best_match_strict(a: matching.Matchable, pool: list[matching.Matchable]) -> tuple[matching.Matchable, float]:
-    best = None
-    best_score = 0.0
-
-    for b in pool:
-        score, _, _ = matching.score_similarity(a, b)
+    return matching.find_best_match_strict(a, pool, app.THRESHOLD_PROBABLE)
 
-        if score >= app.THRESHOLD_PROBABLE:
-            best = b
-            best_score = score
-
-    return best, best_score
-
-def find_best_match(a: matching.Matchable, pool: list[matching.Matchable], allow_unlikely: bool=True, newer_only: bool=False, dec_ts: int=0) -> tuple[matching.Matchable, float, bool]:
+def find_best_match(a: matching.Matchable, pool: list[matching.Matchable], allow_unlikely: bool=True) -> tuple[matching.Matchable, float, bool]:
     best = None
     best_score = 0.0
     satisfied = False
 
     for b in pool:
-
-        if newer_only:
-            print(b.ts_seen)
-            print(dec_ts)
-            print()
-
-        if newer_only and (b.ts_seen <= dec_ts):
-            continue
-
         score, _, _ = matching.score_similarity(a, b)
-        # input(f'{str(b):<70} {score}')
 
         if score >= app.THRESHOLD_CONFIDENT:
             return b, score, True
@@ -141,24 +368,10 @@ def find_best_match(a: matching.Matchable, pool: list[matching.Matchable], allow
 
     return best, best_score, satisfied
 
-def find_best_matches(a: matching.Matchable, pool: list[matching.Matchable], n: int=10) -> tuple[matching.Matchable, float]:
-    options = {}
-
-    for b in pool:
-        score, _, _ = matching.score_similarity(a, b)
-        if score not in options:
-            options[score] = []
-
-        options[score].append(b)
-
-    best = sorted(options, reverse=True)
-    results = []
-
-    for score in best[:n]:
-        for o in options[score]:
-            results.append((score, o))
-    
-    return results
+def find_best_matches(a: matching.Matchable, pool: list[matching.Matchable], n: int=10) -> list[tuple[float, matching.Matchable]]:
+    top = matching.TopK(n)
+    top.extend((matching.score_similarity(a, b)[0], b) for b in pool)
+    return top.results()
 
 def get_unmatched_track_sets() -> tuple[list[matching.MatchDecision], list[Track], list[Track]]:
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
@@ -179,24 +392,30 @@ def get_unmatched_track_sets() -> tuple[list[matching.MatchDecision], list[Track
     return decs, set(all_old.values()), set(all_new.values())
 
 def get_unmatched_album_sets_for_newer() -> tuple[list[matching.MatchDecision], list[Album], list[Album]]:
+    """Old albums last left unmatched or undecided, and the new albums still free to match them."""
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
     lib_old, lib_new = get_libraries()
-    all_old, all_new = lib_old.albums.copy(), lib_new.albums.copy()
+    all_new = lib_new.albums.copy()
 
     for dec in decs:
-        match dec.state:
-            case matching.MatchState.MATCHED:
-                try:
-                    del all_old[dec.old.path]
-                except:
-                    pass
+        if dec.state in (matching.MatchState.MATCHED, matching.MatchState.PARTIAL):
+            all_new.pop(dec.new.path, None)
 
-                try:
-                    del all_new[dec.new.path]
-                except:
-                    pass
+    old = set()
+    for (key, dec) in get_latest_decisions(decs).items():
+        if (dec.state in (matching.MatchState.UNMATCHED, matching.MatchState.UNKNOWN)) and (Path(key) in lib_old.albums):
+            old.add(lib_old.albums[Path(key)])
 
-    return decs, set(all_old.values()), set(all_new.values())
+    return decs, old, set(all_new.values())
+
+def get_latest_decisions(decs: list[matching.MatchDecision]) -> dict[str, matching.MatchDecision]:
+    """The newest decision for each old path."""
+    latest = {}
+    for dec in decs:
+        p = str(dec.old.path)
+        if (p not in latest) or (dec.ts_made > latest[p].ts_made):
+            latest[p] = dec
+    return latest
 
 def get_unmatched_album_sets() -> tuple[list[matching.MatchDecision], list[Album], list[Album]]:
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
@@ -274,6 +493,23 @@ def get_unknown_album_sets() -> tuple[list[matching.MatchDecision], list[Album],
 
     return decs, set(all_old.values()), set(all_new.values())
 
+def get_stored_candidates(new: set[Album]) -> callable:
+    """A lookup of the candidates distribute_album_matching found for an album, if still current."""
+    store = _unpickle(app.PATH_PICKLE_CANDIDATES, {})
+    by_key = {str(b.path): b for b in new}
+    ts_newest = max((b.ts_seen for b in new), default=0)
+
+    def _lookup(a: Album) -> list[tuple[float, Album]]:
+        entry = store.get(str(a.path))
+
+        # Candidates found before the newest albums arrived may have missed them
+        if (entry is None) or (entry[0] < ts_newest):
+            return None
+
+        return [(score, by_key[key]) for (score, key) in entry[1] if key in by_key]
+
+    return _lookup
+
 def report_progress_unknown(n_dec: int, n_old: int, n_new: int) -> None:
     print()
     print(f'Decisions made:       {n_dec}')
@@ -293,11 +529,57 @@ def report_progess_escapees(n_unm: int, n_c_unmatched: int, n_matched: int) -> N
     print(f'Unmatches confirmed among those: {n_c_unmatched}')
     print()
 
+def get_search_index(decs: list[matching.MatchDecision]=None, albums: dict[str, list[Album]]={}) -> object:
+    """The saved search index, brought up to date with the decisions and the albums (by library) given."""
+    import search
+
+    index = _unpickle(app.PATH_PICKLE_SEARCH) or search.SearchIndex()
+    changed = False
+
+    if decs is not None:
+        # A decision is never edited, only added or removed, so its key says whether the index has it
+        describe = lambda d: f'{d.present()} {d.old.path} {d.new.path if d.new is not None else ""}'
+        changed |= index.sync_keys({decision_key(d): d for d in decs}, describe, 'dec')
+
+    for (name, pool) in albums.items():
+        texts = {(f'{name}_album', str(a.path)): describe_album(a) for a in pool}
+        changed |= index.sync(texts, f'{name}_album')
+
+        texts = {(f'{name}_track', key): describe_track(t) for a in pool for (key, t) in a.tracks.items()}
+        changed |= index.sync(texts, f'{name}_track')
+
+    if changed:
+        _pickle(index, app.PATH_PICKLE_SEARCH)
+    return index
+
+def decision_key(d: matching.MatchDecision) -> tuple:
+    return ('dec', str(d.old.path), d.ts_made)
+
+def describe_album(a: Album) -> str:
+    return ' '.join([*sorted(a.data['albumartists']), *sorted(a.data['artists']), a.path.parent.name, a.path.name])
+
+def describe_track(t: Track) -> str:
+    tags = (t.data[k] for k in ('artist', 'albumartist', 'title', 'albumname'))
+    return ' '.join([*(str(v) for v in tags if v is not None), t.path.parent.name, t.path.stem])
+
 def print_decisions() -> None:
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
     for dec in decs:
         print(dec)
 
+def add_decisions(mine: list[matching.MatchDecision]) -> list[matching.MatchDecision]:
+    """
+    Merge decisions into the shared file and return the lot. Reviewers may be
+    adding theirs meanwhile, so every writer rereads it under their lock (see sessions.py).
+    """
+    with tools.FileLock(app.PATH_DECISIONS_LOCK):
+        decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
+        decs.extend(mine)
+        _pickle(decs, app.PATH_PICKLE_DECISIONS)
+
+    mine.clear()
+    return decs
+
 def undo_decision() -> None:
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
     kw = prompts.p_str('Enter a keyword to search for', allow_blank=True).lower().strip()
@@ -305,7 +587,9 @@ def undo_decision() -> None:
         print('Cancelled')
         return
 
-    opts = list(filter(lambda d: (kw in d.present().lower()) or (kw in str(d.old.path).lower()) or ((d.new is not None) and (kw in str(d.new.path).lower())), decs))
+    index = get_search_index(decs)
+    by_key = {decision_key(d): d for d in decs}
+    opts = [by_key[key] for key in index.search(kw, kinds=('dec',))]
     if not opts:
         print('None found')
         return
@@ -316,40 +600,49 @@ def undo_decision() -> None:
         print('Cancelled')
         return
     else:
-        undos = undos.split()
-        for i in (int(undo) for undo in undos):
-            t = opts[i - 1]
-            decs.remove(t)
+        removed = {decision_key(opts[int(undo) - 1]) for undo in undos.split()}
+        for key in removed:
+            index.remove(key)
+
+        with tools.FileLock(app.PATH_DECISIONS_LOCK):
+            decs = [d for d in _unpickle(app.PATH_PICKLE_DECISIONS, []) if decision_key(d) not in removed]
+            _pickle(decs, app.PATH_PICKLE_DECISIONS)
 
-        print(f'Removed {len(undos)} decisions')
+        print(f'Removed {len(removed)} decisions')
 
-    _pickle(decs, app.PATH_PICKLE_DECISIONS)
+    _pickle(index, app.PATH_PICKLE_SEARCH)
 
 def delete_outdated_decs() -> list[matching.MatchDecision]:
-    decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
-    _pickle(decs, app.PATH_PICKLE_DECISIONS_BACKUP)
+    with tools.FileLock(app.PATH_DECISIONS_LOCK):
+        decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
+        _pickle(decs, app.PATH_PICKLE_DECISIONS_BACKUP)
+
+        latest = get_latest_decisions(decs)
+        news = sorted(latest.values(), key=lambda d: d.ts_made)
+        _pickle(news, app.PATH_PICKLE_DECISIONS)
 
-    latest = {}
-    for dec in decs:
-        p = str(dec.old.path)
-        if p not in latest:
-            latest[p] = dec
-        elif dec.ts_made > latest[p].ts_made:
-            latest[p] = dec
-    
-    news = sorted(latest.values(), key=lambda d: d.ts_made)
     print(f'Eliminated {len(decs) - len(news)} outdated decisions')
-    _pickle(news, app.PATH_PICKLE_DECISIONS)
 
 def update_decs_version() -> None:
-    decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
-    _pickle(decs, app.PATH_PICKLE_DECISIONS_BACKUP)
+    """Rewrite decisions and escapees in the current format, which refers to tracks and albums by key."""
+    n_before = sum(path.stat().st_size for path in (app.PATH_PICKLE_DECISIONS, app.PATH_PICKLE_ESCAPEES) if path.exists())
+
+    with tools.FileLock(app.PATH_DECISIONS_LOCK):
+        # The backup is the file as it was, not as this version would write it
+        decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
+        if decs:
+            shutil.copyfile(app.PATH_PICKLE_DECISIONS, app.PATH_PICKLE_DECISIONS_BACKUP)
 
-    news = []
-    for d in decs:
-        news.append(matching.MatchDecision.remake(d))
+        news = []
+        for d in decs:
+            news.append(matching.MatchDecision.remake(d))
 
-    _pickle(news, app.PATH_PICKLE_DECISIONS)
+        _pickle(news, app.PATH_PICKLE_DECISIONS)
+
+    _pickle(get_escapees(), app.PATH_PICKLE_ESCAPEES)
+
+    n_after = sum(path.stat().st_size for path in (app.PATH_PICKLE_DECISIONS, app.PATH_PICKLE_ESCAPEES))
+    print(f'Rewrote {len(news)} decisions: {n_before / 1_024:,.0f} KB -> {n_after / 1_024:,.0f} KB')
 
 def format_track_comparison_row(a: Track, b: Track, score: float) -> list[str]:
     cols = []
@@ -358,18 +651,45 @@ def format_track_comparison_row(a: Track, b: Track, score: float) -> list[str]:
     cols.append(f'{score:<.2f}')
     return cols
 
-def compare_albums(a: Album, b: Album) -> tuple[matching.MatchState, list[Track]]:
-    """Returns a MatchState and Tracks from a that are not matches in b."""
+_alignments: AlignmentCache = None
+
+def get_alignment_cache() -> AlignmentCache:
+    global _alignments
+    if _alignments is None:
+        # Alignments depend on how tracks are scored and what counts as a match
+        settings = repr((sorted(Track.weights.items()), app.THRESHOLD_CONFIDENT, app.THRESHOLD_PROBABLE, app.THRESHOLD_POSSIBLE))
+        _alignments = AlignmentCache(app.PATH_PICKLE_ALIGNMENTS, hashlib.blake2b(settings.encode(), digest_size=8).hexdigest())
+        old, new = matching.get_library('old'), matching.get_library('new')
+        if (old is not None) and (new is not None):
+            _alignments.prune(old.albums, new.albums)
+    return _alignments
+
+def align_albums(a: Album, b: Album) -> tuple[list[Track], list[list[str]], list[Track], list[list[str]]]:
+    """Pair each track of a with its best match in b. Returns aligned and misaligned tracks and rows."""
     aligned_tracks = []
     aligned_rows = []
     misaligned_tracks = []
     misaligned_rows = []
 
-    ours = list(a.tracks.values())
-    pool = list(b.tracks.values())
+    cache = get_alignment_cache()
+    pairs = cache.get(a, b)
 
-    for track in ours:
-        best, score, satisfied = find_best_match(track, pool, allow_unlikely=False)
+    if pairs is None:
+        ours = list(a.tracks.values())
+        pool = list(b.tracks.values())
+
+        pairs = []
+        for track in ours:
+            best, score, satisfied = find_best_match(track, pool, allow_unlikely=False)
+            pairs.append((str(track.path), str(best.path) if best is not None else None, score, satisfied))
+            if satisfied:
+                pool.remove(best)
+
+        cache.put(a, b, pairs)
+
+    for (key, key_best, score, satisfied) in pairs:
+        track = a.tracks[key]
+        best = b.tracks[key_best] if key_best is not None else None
 
         if not satisfied:
             misaligned_tracks.append(track)
@@ -377,11 +697,22 @@ def compare_albums(a: Album, b: Album) -> tuple[matching.MatchState, list[Track]
         else:
             aligned_tracks.append(track)
             aligned_rows.append(format_track_comparison_row(track, best, score))
-            pool.remove(best)
 
     # aligned_rows.sort(key=lambda row: row[2], reverse=True)
     # misaligned_rows.sort(key=lambda row: row[2], reverse=True)
 
+    return aligned_tracks, aligned_rows, misaligned_tracks, misaligned_rows
+
+def compare_albums(a: Album, b: Album, alignment: tuple=None) -> tuple[matching.MatchState, list[Track]]:
+    """Returns a MatchState and Tracks from a that are not matches in b."""
+    from tabulate import tabulate
+
+    if alignment is None:
+        alignment = align_albums(a, b)
+
+    # Copies, since revisions below shuffle tracks between the lists
+    aligned_tracks, aligned_rows, misaligned_tracks, misaligned_rows = (l[:] for l in alignment)
+
     if not misaligned_rows:
         return matching.MatchState.MATCHED, []
 
@@ -479,31 +810,126 @@ def compare_albums(a: Album, b: Album) -> tuple[matching.MatchState, list[Track]
             return matching.MatchState.UNKNOWN, []
         
 def find_track_escapees() -> None:
+    from concurrent.futures import ProcessPoolExecutor
+    import progressbar
+    import features
+    import workers
+
     _, unm, new = get_unmatched_track_sets()
-    bests = _unpickle(app.PATH_PICKLE_ESCAPEES, {})
+    bests = get_escapees()
+    seen = _unpickle(app.PATH_PICKLE_ESCAPEES_SEEN, {}) # Old track key: when it was last scored against the new library
+    ts_run = tools.ts_now()
+
+    # found holds new track keys rather than Tracks so the checkpoint stays small
+    found, done = {}, set()
+    checkpoint = _unpickle(app.PATH_PICKLE_ESCAPEES_CHECKPOINT)
+    if (checkpoint is not None) and prompts.p_bool('Resume the interrupted search'):
+        found, done = checkpoint
+        print(f'Resuming after {len(done)} tracks')
 
     ow = False
-    if bests:
-        ow = prompts.p_bool('Overwrite existing bests')
+    if seen:
+        ow = prompts.p_bool('Rescore everything from scratch')
         if ow:
-            print('Overwriting')
+            print('Rescoring all tracks against the whole new library')
+        else:
+            print('Scoring only what changed since the last search')
+
+    # Tracks that were scored before only need the new tracks that arrived since,
+    # unless they changed themselves or their best match is gone
+    keys_new = set(str(b.path) for b in new)
+    since = {}
+    for t in unm:
+        key = str(t.path)
+        if ow or (key not in seen) or (t.ts_seen > seen[key]):
+            since[key] = 0
+        elif (key in bests) and (bests[key][0] not in keys_new):
+            since[key] = 0
         else:
-            print('Not overwriting')
+            since[key] = seen[key]
 
-    bar = progressbar.ProgressBar()
-    for a in bar(unm):
-        if ow or (str(a.path) not in bests):
-            best, score = find_best_match_strict(a, new)
-            if best is not None:
-                bests[str(a.path)] = (best, score)
+    ts_newest = max((b.ts_seen for b in new), default=0)
+    todo = [t for t in unm if (str(t.path) not in done) and (since[str(t.path)] < ts_newest)]
+    
+    # One batch of chunks per cut-off, so each chunk is scored against one pool
+    groups = {}
+    for t in todo:
+        groups.setdefault(since[str(t.path)], []).append(t)
+
+    # Workers map both sides from disk and are sent only row ranges of the old side
+    ordered, chunks = [], []
+    for (ts, group) in groups.items():
+        start = len(ordered)
+        ordered.extend(group)
+        chunks.extend((i, min(i + app.ESCAPEE_CHUNK_SIZE, len(ordered)), ts) for i in range(start, len(ordered), app.ESCAPEE_CHUNK_SIZE))
+
+    fill_for_workers(ordered + list(new))
+    features.save(ordered, app.PATH_FEATURES_OLD)
+    features.save(list(new), app.PATH_FEATURES_NEW)
+
+    n_full = len(groups.get(0, []))
+    print(f'Searching for {len(todo)} tracks ({n_full} in full, {len(todo) - n_full} against newer tracks only) with {app.N_WORKERS} workers')
+    pool = ProcessPoolExecutor(app.N_WORKERS, initializer=workers.init_tables, initargs=(app.PATH_FEATURES_OLD, app.PATH_FEATURES_NEW, app.THRESHOLD_PROBABLE))
+    ts_saved = time.monotonic()
+
+    try:
+        futures = [pool.submit(workers.find_escapees_range, start, stop, ts) for (start, stop, ts) in chunks]
+        bar = progressbar.ProgressBar(max_value=len(todo))
+        n_searched = 0
+
+        for f in as_completed(futures):
+            results, keys = f.result()
+            found.update(results)
+            done.update(keys)
+
+            n_searched += len(keys)
+            bar.update(n_searched)
+
+            if time.monotonic() - ts_saved >= app.CHECKPOINT_INTERVAL:
+                _pickle((found, done), app.PATH_PICKLE_ESCAPEES_CHECKPOINT)
+                ts_saved = time.monotonic()
+
+        bar.finish()
+
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        _pickle((found, done), app.PATH_PICKLE_ESCAPEES_CHECKPOINT)
+        print(f'\nInterrupted; {len(done)} tracks searched so far are saved for next time')
+        return
+
+    pool.shutdown()
+    Path.unlink(app.PATH_FEATURES_OLD, missing_ok=True)
+    Path.unlink(app.PATH_FEATURES_NEW, missing_ok=True)
+
+    # Tracks that have been matched since drop out
+    keys_unm = set(since)
+    bests = {key: best for (key, best) in bests.items() if key in keys_unm}
+    seen = {key: ts for (key, ts) in seen.items() if key in keys_unm}
+
+    # A full search replaces the old best; a search of newer tracks only has to beat it
+    for key in done:
+        if key not in keys_unm:
+            continue # A resumed search may predate a match
+
+        if since[key] == 0:
+            bests.pop(key, None)
+
+        if key in found:
+            key_best, score = found[key]
+            if (key_best in keys_new) and ((key not in bests) or (score > bests[key][1])):
+                bests[key] = (key_best, score)
+
+        seen[key] = ts_run
 
     print(f'Perhaps {len(bests)} unmatched tracks can be individually matched')
     print(f'Pickling the best options')
     _pickle(bests, app.PATH_PICKLE_ESCAPEES)
+    _pickle(seen, app.PATH_PICKLE_ESCAPEES_SEEN)
+    Path.unlink(app.PATH_PICKLE_ESCAPEES_CHECKPOINT, missing_ok=True)
         
 def do_track_escapees() -> None:
-    decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
-    bests = _unpickle(app.PATH_PICKLE_ESCAPEES, {})
+    mine = []
+    bests = get_escapees()
     lib_old, lib_new = get_libraries()
 
     report_progess_escapees(len(bests), 0, 0)
@@ -517,8 +943,14 @@ def do_track_escapees() -> None:
     i = 0
     while i < len(keys):
         key = keys[i]
-        t = lib_old.tracks[key]
-        (best, score) = bests[key]
+        (key_best, score) = bests[key]
+
+        # Either side may have gone from the library since the search
+        t, best = lib_old.tracks.get(key), lib_new.tracks.get(key_best)
+        if (t is None) or (best is None):
+            del bests[key]
+            i += 1
+            continue
 
         p = f'{Track.present(t):<80} {Track.present(best):<80} {score:<.2f} ::: '
 
@@ -530,7 +962,7 @@ def do_track_escapees() -> None:
         choice = m.group(0)
 
         if choice == 'Y':
-            decs.append(matching.MatchDecision(t, best, matching.MatchState.MATCHED, score, tools.ts_now()))
+            mine.append(matching.MatchDecision(t, best, matching.MatchState.MATCHED, score, tools.ts_now()))
             del bests[key]
 
             n_matched += 1
@@ -542,7 +974,7 @@ def do_track_escapees() -> None:
             continue
             
         elif choice == 'N':
-            decs.append(matching.MatchDecision(t, best, matching.MatchState.CONFIRMED_UNMATCHED, score, tools.ts_now()))
+            mine.append(matching.MatchDecision(t, best, matching.MatchState.CONFIRMED_UNMATCHED, score, tools.ts_now()))
             del bests[key]
 
             n_c_unmatched += 1
@@ -550,7 +982,7 @@ def do_track_escapees() -> None:
 
         elif choice == 'S':
             report_progess_escapees(len(bests), n_c_unmatched, n_matched)
-            _pickle(decs, app.PATH_PICKLE_DECISIONS)
+            add_decisions(mine)
             _pickle(bests, app.PATH_PICKLE_ESCAPEES)
             continue
         
@@ -561,31 +993,303 @@ def do_track_escapees() -> None:
     
     report_progess_escapees(len(bests), n_c_unmatched, n_matched)
     _pickle(bests, app.PATH_PICKLE_ESCAPEES)
-    _pickle(decs, app.PATH_PICKLE_DECISIONS)
+    add_decisions(mine)
+
+def fill_for_workers(items: list[matching.Matchable]) -> None:
+    """Read what a fast scan left out before workers score copies, which would read it again and lose it."""
+    import progressbar
+
+    with tools.IOPriority(app.IO_PRIORITY), tools.limit_io(app.SCAN_BYTES_PER_SEC, app.SCAN_FILES_PER_SEC):
+        bar = progressbar.ProgressBar()
+        for m in bar(items):
+            m.fill()
+    library.save_tag_cache()
+
+def run_distributed(kind: str, items: list[matching.Matchable], pool: list[matching.Matchable], params: dict) -> dict:
+    """Hand items out to workers in units and gather what they find, keyed by item."""
+    import progressbar
+    import distributed
+
+    fill_for_workers(items + pool)
+
+    units = [items[i:i + app.UNIT_SIZE] for i in range(0, len(items), app.UNIT_SIZE)]
+    coordinator = distributed.Coordinator(kind, units, pool, params, app.LEASE_TIMEOUT)
+    host, port = app.COORDINATOR
+
+    # Connections exchange pickles, so whoever has the key can run code here
+    local = host in ('localhost', '127.0.0.1', '::1')
+    if app.AUTHKEY is None:
+        if not local:
+            print(f'Refusing to serve on {host or "all interfaces"} without an AUTHKEY in {app.PATH_CONFIG}')
+            return {}
+
+        app.AUTHKEY = secrets.token_hex(16).encode()
+        print(f'No AUTHKEY configured; using {app.AUTHKEY.decode()} for this run')
+
+    distributed.serve(coordinator, host, port, app.AUTHKEY)
+
+    print(f'Serving {len(units)} units of work on port {port}')
+    if not local:
+        print(f'Start remote workers with: python src/distributed.py <this host> {port} <authkey>')
+    n_local = prompts.p_int('Local workers to start', lower=0, allow_blank=True) or 0
+
+    # Local workers map both sides from disk rather than each fetching the pool
+    tables = None
+    if n_local:
+        import features
+        cls = Album if kind == distributed.KIND_ALBUMS else Track
+        features.save(items, app.PATH_FEATURES_OLD, cls)
+        features.save(pool, app.PATH_FEATURES_NEW, cls)
+        tables = (str(app.PATH_FEATURES_OLD), str(app.PATH_FEATURES_NEW))
+    distributed.start_local(n_local, host or 'localhost', port, app.AUTHKEY, tables)
+
+    bar = progressbar.ProgressBar(max_value=len(units))
+    try:
+        while not coordinator.is_done():
+            bar.update(coordinator.n_done())
+            time.sleep(1)
+        bar.finish()
+
+    except KeyboardInterrupt:
+        print(f'\nInterrupted; keeping {coordinator.n_done()} of {len(units)} units')
+
+    merged = {}
+    for result in list(coordinator.results.values()):
+        merged.update(result)
+    return merged
+
+def distribute_album_matching() -> None:
+    import distributed
+
+    _, old, new = get_unknown_album_sets()
+    ts = tools.ts_now()
+
+    found = run_distributed(distributed.KIND_ALBUMS, list(old), list(new), {'threshold': app.THRESHOLD_PROBABLE, 'n': 10})
+
+    # Keep the raw measures too, for rerank_candidates
+    sims = SimilarityCache(app.PATH_PICKLE_SIMILARITIES)
+    by_key_old, by_key_new = {str(a.path): a for a in old}, {str(b.path): b for b in new}
+
+    store = _unpickle(app.PATH_PICKLE_CANDIDATES, {})
+    for (key, candidates) in found.items():
+        store[key] = (ts, [(score, key_b) for (score, key_b, _) in candidates])
+        for (_, key_b, raw) in candidates:
+            sims.put(by_key_old[key], by_key_new[key_b], raw)
+
+    _pickle(store, app.PATH_PICKLE_CANDIDATES)
+    sims.save()
+    print(f'Stored candidates for {len(found)} albums')
+
+def stream_album_matching() -> None:
+    """As distribute_album_matching, but a chunk of albums at a time, for libraries too big to hold in memory."""
+    import gc
+    import progressbar
+    import columnar
+    import streaming
+
+    if app.CACHE_FORMAT != 'columnar':
+        print('Streaming works from the memory-mapped caches; set CACHE_FORMAT :: columnar')
+        return
+
+    # Bring each root's cache up to date, one root at a time, keeping none of them
+    scan = not watch.is_watched(app.PATH_WATCH_HEARTBEAT, app.WATCH_STALE)
+    tags = TagCache(app.PATH_PICKLE_TAGS)
+    for (name, paths, path_pickle_legacy) in (
+        ('lib_old', app.PATHS_LIB_OLD, app.PATH_PICKLE_LIB_OLD),
+        ('lib_new', app.PATHS_LIB_NEW, app.PATH_PICKLE_LIB_NEW)):
+
+        for path in paths:
+            load_root(name, path, path_pickle_legacy, False, scan, tags)
+    tags.save()
+    library.use_tag_cache(tags)
+    gc.collect()
+
+    # Only the keys of decided albums are kept
+    decided, taken = set(), set()
+    for dec in _unpickle(app.PATH_PICKLE_DECISIONS, []):
+        if dec.state in (matching.MatchState.MATCHED, matching.MatchState.PARTIAL):
+            taken.add(str(dec.new.path))
+        if dec.state is not matching.MatchState.UNKNOWN:
+            decided.add(str(dec.old.path))
+    gc.collect()
+
+    paths_new = [app.path_cache_root('lib_new', path) for path in app.PATHS_LIB_NEW]
+    stores_new = [columnar.Store(path) for path in paths_new]
+    print('Indexing the new library...')
+    index = streaming.CandidateIndex.open(app.PATH_CANDIDATE_INDEX, stores_new, paths_new)
+
+    ts = tools.ts_now()
+    weights = tuple(Album.weights.values())
+
+    # Results go to disk a chunk at a time; the stored candidates and measures are only loaded to merge them
+    spill = tools.Spill(Path(f'{app.PATH_PICKLE_CANDIDATES}.spill'))
+    found = []
+    stores_old = [columnar.Store(app.path_cache_root('lib_old', path)) for path in app.PATHS_LIB_OLD]
+    n_done = 0
+    bar = progressbar.ProgressBar(max_value=sum(store.header['n_albums'] for store in stores_old))
+
+    try:
+        for store in stores_old:
+            for j in range(store.header['n_albums']):
+                n_done += 1
+                if store.string(store.cols['albums.path'][j]) in decided:
+                    continue
+
+                a = store.album(j)
+                top = matching.TopK(10)
+                for ref in index.candidates(streaming.album_tokens(a), app.STREAM_CANDIDATES):
+                    b = stores_new[ref >> 32].album(ref & 0xFFFFFFFF)
+                    if str(b.path) not in taken:
+                        raw = matching.measure_raw(a, b)
+                        top.push(matching.weigh(raw, weights), (b, raw))
+
+                best = [(score, str(b.path)) for (score, (b, _)) in top.results()]
+                found.append((str(a.path), best, [SimilarityCache.encode(a, b, raw) for (_, (b, raw)) in top.results()]))
+
+                # Old albums are needed once; new ones stay built until memory runs short
+                if n_done % app.STREAM_CHUNK_SIZE == 0:
+                    bar.update(n_done)
+                    spill.write(found)
+                    found.clear()
+                    store.made.clear()
+                    rss = tools.rss_mb()
+                    if (rss is None) or (rss > app.MEMORY_LIMIT_MB):
+                        for s in stores_new:
+                            s.made.clear()
+                        gc.collect()
+
+            store.made.clear()
+
+        bar.finish()
+
+    except KeyboardInterrupt:
+        print(f'\nInterrupted; keeping candidates for {spill.n + len(found)} albums')
+
+    spill.write(found)
+    found.clear()
+    index.close()
+    for s in stores_old + stores_new:
+        s.made.clear()
+        s.close()
+    gc.collect()
+
+    candidates = _unpickle(app.PATH_PICKLE_CANDIDATES, {})
+    sims = SimilarityCache(app.PATH_PICKLE_SIMILARITIES)
+    fields = tuple(Album.weights)
+    for (key, best, pairs) in spill:
+        candidates[key] = (ts, best)
+        for (key_pair, entry) in pairs:
+            sims.put_encoded(fields, key_pair, entry)
+    _pickle(candidates, app.PATH_PICKLE_CANDIDATES)
+    sims.save()
+    spill.close()
+    print(f'Stored candidates for {spill.n} albums')
+
+def rerank_candidates() -> None:
+    """Try other album weights and thresholds on the stored candidates, from their raw measures alone."""
+    sims = SimilarityCache(app.PATH_PICKLE_SIMILARITIES)
+    candidates = _unpickle(app.PATH_PICKLE_CANDIDATES, {})
+    fields = sims.fields.get(Album.__name__)
+    if (fields is None) or (fields != tuple(Album.weights)):
+        print('No raw measures stored for the current album fields; run distribute_album_matching or stream_album_matching')
+        return
+
+    # To tell which measures were taken before either album last changed
+    lib_old, lib_new = get_libraries()
+
+    print('Album weights: ' + ', '.join(f'{k}={v}' for (k, v) in Album.weights.items()))
+    weights = dict(Album.weights)
+    changes = prompts.p_str('Weights to change, e.g. folder_name=8 duration=3', allow_blank=True)
+    for change in changes.split():
+        k, v = change.split('=')
+        if k not in weights:
+            print(f'No field {k}')
+            return
+        weights[k] = float(v)
+    threshold = prompts.p_float('Threshold', lower=0, upper=1, allow_blank=True)
+    if threshold is None:
+        threshold = app.THRESHOLD_PROBABLE
+
+    # Every stored pair still measured on the albums as they are, grouped by old album
+    ts_started = time.perf_counter()
+    vector = tuple(weights[k] for k in fields)
+    by_old = {}
+    for (kind, key_a, key_b) in sims.pairs:
+        if kind != Album.__name__:
+            continue
+
+        a, b = lib_old.albums.get(Path(key_a)), lib_new.albums.get(Path(key_b))
+        raw = None if (a is None) or (b is None) else sims.get(a, b)
+        if raw is not None:
+            by_old.setdefault(key_a, []).append((matching.weigh(raw, vector), key_b))
+
+    reranked = {}
+    n_moved, n_above_before, n_above_after = 0, 0, 0
+    for (key, (ts, before)) in candidates.items():
+        after = sorted(by_old.get(key, []), key=lambda pair: pair[0], reverse=True)
+        if not after:
+            continue
+
+        reranked[key] = (ts, after)
+        n_moved += (not before) or (before[0][1] != after[0][1])
+        n_above_before += bool(before) and (before[0][0] >= threshold)
+        n_above_after += after[0][0] >= threshold
+
+    print(f'Reranked {len(reranked)} albums in {time.perf_counter() - ts_started:.2f} s')
+    print(f'Top candidate changed for {n_moved}')
+    print(f'Top candidate at or above {threshold:.2f}: {n_above_before} before, {n_above_after} after')
+
+    if reranked and prompts.p_bool('Store the reranked candidates'):
+        candidates.update(reranked)
+        _pickle(candidates, app.PATH_PICKLE_CANDIDATES)
+        print('Stored; to keep these weights for scoring too, put them in Album.weights')
+
+def distribute_escapee_matching() -> None:
+    import distributed
+
+    _, unm, new = get_unmatched_track_sets()
+    bests = get_escapees()
+    todo = [a for a in unm if str(a.path) not in bests]
+
+    found = run_distributed(distributed.KIND_TRACKS, todo, list(new), {'threshold': app.THRESHOLD_PROBABLE, 'n': 1})
+    bests.update(found)
+    _pickle(bests, app.PATH_PICKLE_ESCAPEES)
+    print(f'Perhaps {len(bests)} unmatched tracks can be individually matched')
 
 def check_unknown_all() -> None:
     check_unknown()
 
 def check_unknown_newer() -> None:
-    print('This functionality does not work yet because timestamps were not saved properly')
-    return
     check_unknown(newer_only=True)
 
 def check_unmatched() -> None:
-    decs, unm, new = get_unmatched_album_sets()
+    mine = []
+    _, unm, new = get_unmatched_album_sets()
     report_progess_unmatched(len(unm))
 
-    print('n = confirm no match; m # = matched after all; e # = open folders; q = stop for now; s = save\n')
+    print('n = confirm no match; m # = matched after all; e # = open folders; f words = search to match; q = stop for now; s = save\n')
 
     unm = list(unm)
     n_decided = 0
 
+    stored = get_stored_candidates(new)
+    index = get_search_index(albums={'new': new})
+
+    # Candidates and the alignment with the top one, worked out ahead of time
+    def _review(a: Album) -> tuple[list[tuple[float, Album]], tuple]:
+        best = stored(a) or find_best_matches(a, new)
+        alignment = align_albums(a, best[0][1]) if best else None
+        return best, alignment
+
+    prefetcher = Prefetcher(_review)
+
     i = 0
     while i < len(unm):
         a = unm[i]
         print(a.present())
 
-        best = find_best_matches(a, new)
+        prefetcher.ahead(unm[i + 1:i + 1 + app.PREFETCH_DEPTH])
+        best, alignment = prefetcher.get(a)
         
         for (n, pair) in enumerate(best):
             score, option = pair
@@ -604,11 +1308,27 @@ def check_unmatched() -> None:
             n = int(choice.split()[1])
             b = best[n - 1][1]
 
+            state, unmatched_tracks = compare_albums(a, b, alignment if n == 1 else None)
+            mine.append(matching.MatchDecision(a, b, state, score, tools.ts_now(), omit=unmatched_tracks[:]))
+            print(f'Marked as matched with {b.present()}')
+            print()
+
+            prefetcher.forget(a)
+            n_decided += 1
+            i += 1
+
+        elif choice.startswith('F'):
+            b = pick_search_result(a, index, choice[2:], new)
+            if b is None:
+                continue
+
+            score = matching.score_similarity(a, b)[0]
             state, unmatched_tracks = compare_albums(a, b)
-            decs.append(matching.MatchDecision(a, b, state, score, tools.ts_now(), omit=unmatched_tracks[:]))
+            mine.append(matching.MatchDecision(a, b, state, score, tools.ts_now(), omit=unmatched_tracks[:]))
             print(f'Marked as matched with {b.present()}')
             print()
 
+            prefetcher.forget(a)
             n_decided += 1
             i += 1
 
@@ -620,22 +1340,51 @@ def check_unmatched() -> None:
                 os.startfile(b.path)
             
         elif choice == 'N':
-            decs.append(matching.MatchDecision(a, None, matching.MatchState.CONFIRMED_UNMATCHED, score, tools.ts_now()))
+            mine.append(matching.MatchDecision(a, None, matching.MatchState.CONFIRMED_UNMATCHED, score, tools.ts_now()))
             print(f'Marked as confirmed unmatched')
             print()
 
+            prefetcher.forget(a)
             n_decided += 1
             i += 1
 
         elif choice == 'S':
             report_progess_unmatched(len(unm) - n_decided)
-            _pickle(decs, app.PATH_PICKLE_DECISIONS)
+            add_decisions(mine)
+            get_alignment_cache().save()
         
         elif choice == 'Q':
             break
     
+    prefetcher.close()
     report_progess_unmatched(len(unm) - n_decided)
-    _pickle(decs, app.PATH_PICKLE_DECISIONS)
+    add_decisions(mine)
+    get_alignment_cache().save()
+
+def pick_search_result(a: Album, index: object, query: str, pool: set[Album], n: int=10) -> Album:
+    """Show the albums in pool that match the query, best first, and return the one chosen, if any."""
+    by_path = {str(b.path): b for b in pool}
+    by_track = {key: b for b in pool for key in b.tracks}
+
+    found = []
+    for (kind, key) in index.search(query, kinds=('new_album', 'new_track')):
+        b = by_path.get(key) if kind == 'new_album' else by_track.get(key)
+        if (b is not None) and (b not in found):
+            found.append(b)
+            if len(found) == n:
+                break
+
+    if not found:
+        print('None found\n')
+        return None
+
+    for (e, b) in enumerate(found):
+        score = matching.score_similarity(a, b)[0]
+        print(f'\t{e + 1:>2}.   {score:<.2f} : {b.present()}')
+    print()
+
+    choice = prompts.p_int('Number to match with, or Enter to cancel', lower=1, upper=len(found), allow_blank=True)
+    return found[choice - 1] if choice is not None else None
 
 def check_unknown(newer_only: bool=False) -> None:
     
@@ -651,25 +1400,66 @@ def check_unknown(newer_only: bool=False) -> None:
     old = list(old)
     n_matched = 0
 
+    # Rechecking only needs the albums that arrived since the last decision,
+    # and only a better candidate than the one turned down is worth showing
+    latest = get_latest_decisions(decs) if newer_only else {}
+
+    # The best candidate and its track alignment, worked out ahead of time.
+    # Each job scores against a snapshot of new taken when it was queued.
+    def _review(a: Album, pool: tuple[Album]) -> tuple[Album, float, tuple]:
+        if newer_only:
+            dec = latest[str(a.path)]
+            b, score, _ = find_best_match(a, [b for b in pool if b.ts_seen > dec.ts_made])
+            if score <= dec.score:
+                b = None
+        else:
+            candidates = [(score, b) for (score, b) in (stored(a) or []) if b not in taken]
+            if candidates:
+                score, b = candidates[0]
+            else:
+                b, score, _ = find_best_match(a, pool)
+        alignment = align_albums(a, b) if b is not None else None
+        return b, score, alignment
+
+    # Results whose candidate has since been matched to another album must be redone
+    taken = set()
+    stored = get_stored_candidates(new)
+    prefetcher = Prefetcher(_review)
+
+    # Other reviewers may be working through the same albums; see sessions.py
+    import sessions
+    session = sessions.ReviewSession(app.REVIEWER, app.PATH_PICKLE_DECISIONS, app.PATH_PICKLE_LEASES, app.PATH_DECISIONS_LOCK, app.REVIEW_LEASE_TIMEOUT, app.REVIEW_BATCH_SIZE)
+    mine = []
+    busy = set()
+    by_path = {str(b.path): b for b in new}
+
     i = 0    
     while i < len(old):
         a = old[i]
 
-        if newer_only:
-            newest_ts = 0
-            for dec in decs:
-                if dec.old == a:
-                    if dec.ts_made > newest_ts:
-                        newest_ts = dec.ts_made
+        # Leases another reviewer has since taken over drop out of session.held
+        if str(a.path) not in session.held:
+            if str(a.path) not in busy:
+                _, others, matched = session.claim(str(old[j].path) for j in range(i, len(old)))
+                busy.update(others)
 
-            if newest_ts == 0:
-                b = None
-            else:
-                b, score, _ = find_best_match(a, new, newer_only=True, dec_ts=newest_ts)
-        else:
-            b, score, _ = find_best_match(a, new)
+                # New albums others have matched meanwhile are off the table
+                for key in matched:
+                    if (key in by_path) and (by_path[key] in new):
+                        new.remove(by_path[key])
+                        taken.add(by_path[key])
+
+            if str(a.path) not in session.held:
+                prefetcher.forget(a)
+                i += 1
+                continue
+
+        snapshot = tuple(new)
+        prefetcher.ahead(old[i + 1:i + 1 + app.PREFETCH_DEPTH], snapshot)
+        b, score, alignment = prefetcher.get(a, snapshot, stale=lambda r: r[0] in taken)
 
         if b is None:
+            prefetcher.forget(a)
             i += 1
             continue
 
@@ -690,11 +1480,13 @@ def check_unknown(newer_only: bool=False) -> None:
         choice = m.group(0)
 
         if choice == 'Y':
-            state, unmatched_tracks = compare_albums(a, b)
+            state, unmatched_tracks = compare_albums(a, b, alignment)
 
-            decs.append(matching.MatchDecision(a, b, state, score, tools.ts_now(), omit=unmatched_tracks[:]))
+            mine.append(matching.MatchDecision(a, b, state, score, tools.ts_now(), omit=unmatched_tracks[:]))
             new.remove(b)
+            taken.add(b)
 
+            prefetcher.forget(a)
             n_matched += 1
             i += 1
 
@@ -704,48 +1496,69 @@ def check_unknown(newer_only: bool=False) -> None:
             continue
             
         elif choice == 'N':
-            decs.append(matching.MatchDecision(a, b, matching.MatchState.UNMATCHED, score, tools.ts_now()))
+            mine.append(matching.MatchDecision(a, b, matching.MatchState.UNMATCHED, score, tools.ts_now()))
+            prefetcher.forget(a)
             i += 1
 
         elif choice == 'S':
+            decs = session.save(mine)
             report_progress_unknown(len(decs), len(old) - n_matched, len(new))
-            _pickle(decs, app.PATH_PICKLE_DECISIONS)
+            get_alignment_cache().save()
             continue
         
         elif choice == 'Q':
             break
 
+    prefetcher.close()
+    decs = session.save(mine)
+    session.close()
     report_progress_unknown(len(decs), len(old) - n_matched, len(new))
-    _pickle(decs, app.PATH_PICKLE_DECISIONS)
+    get_alignment_cache().save()
+
+def get_cull_prefix(root: Path) -> Path:
+    # Keep roots apart in the cull when there are several, telling
+    # apart roots whose folders share a name by a hash of the full path
+    if len(app.PATHS_LIB_OLD) == 1:
+        return Path()
+    if sum(other.name == root.name for other in app.PATHS_LIB_OLD) > 1:
+        return Path(f'{root.name}_{hashlib.md5(str(root).encode()).hexdigest()[:8]}')
+    return Path(root.name)
 
 def rebase_path(path: Path) -> Path:
-    parts = list(path.parts)
-    for part in app.PATH_LIB_OLD.parts:
-        parts.remove(part)
-    path = app.PATH_LIB_CULL / Path(*parts)
-    return path
+    for root in app.PATHS_LIB_OLD:
+        if path.is_relative_to(root):
+            return app.PATH_LIB_CULL / get_cull_prefix(root) / path.relative_to(root)
+
+    raise ValueError(f'{path} is not under any old library root')
+
+def unbase_path(path: Path) -> Path:
+    """The old library file a file in the cull was copied from, or None."""
+    for root in app.PATHS_LIB_OLD:
+        base = app.PATH_LIB_CULL / get_cull_prefix(root)
+        if path.is_relative_to(base):
+            return root / path.relative_to(base)
+
+    return None
 
 def get_unmatched_paths() -> set[Path]:
     decs = _unpickle(app.PATH_PICKLE_DECISIONS, [])
+    get_libraries() # Decisions only know the albums by key
     paths = set()
 
+    # By the keys the decisions keep, so tracks gone from the library aren't dropped from the cull
     for dec in decs: 
         if dec.state is matching.MatchState.PARTIAL:
-            for (key, t) in dec.old.tracks.items():
-                if key not in dec.omit:
-                    paths.add(t.path)
+            omit = set(dec.omit)
+            paths.update(Path(key) for key in dec.track_keys if key not in omit)
 
         elif dec.state is matching.MatchState.CONFIRMED_UNMATCHED:
-            if isinstance(dec.old, Album):
-                for t in dec.old.tracks.values():
-                    paths.add(t.path)
-
-            elif isinstance(dec.old, Track):
-                paths.add(dec.old.path)
+            paths.update(Path(key) for key in dec.track_keys)
 
     return paths
 
 def sync_cull() -> None:
+    import progressbar
+
     are = tools.get_filepaths(app.PATH_LIB_CULL, EXTS)
     should_be = get_unmatched_paths()
 
@@ -754,7 +1567,12 @@ def sync_cull() -> None:
 
     targets = set(target_source)
 
-    to_remove = are.difference(targets)
+    # A file whose source is gone can't be told apart from one that is still wanted, so it stays
+    extra = are.difference(targets)
+    to_remove = {found for found in extra if ((source := unbase_path(found)) is not None) and source.exists()}
+    if len(to_remove) < len(extra):
+        print(f'Keeping {len(extra) - len(to_remove)} files in the cull whose source is gone')
+
     if not to_remove:
         print('No files to remove from the cull')
     else:
@@ -764,42 +1582,119 @@ def sync_cull() -> None:
             # print(f'Would be removing {found}')
             os.remove(found)
 
-    to_copy = targets.difference(are)
+    to_copy = {target for target in targets.difference(are) if target_source[target].exists()}
     if not to_copy:
         print('No files to add to the cull')
     else:
         print(f'Adding {len(to_copy)} files that should be in the cull...')
-        bar = progressbar.ProgressBar()
-        for target in bar(to_copy):
-            source = target_source[target]
-            # print(f'Would be copying {source} to {target}')
-            if not Path.exists(target.parent):
-                Path.mkdir(target.parent, parents=True, exist_ok=True)
-            shutil.copy2(source, target.parent)
+        with tools.IOPriority(app.IO_PRIORITY), tools.limit_io(app.CULL_BYTES_PER_SEC, app.CULL_FILES_PER_SEC) as throttle:
+            bar = tools.make_io_bar(len(to_copy))
+            for target in bar(to_copy):
+                source = target_source[target]
+                # print(f'Would be copying {source} to {target}')
+                if not Path.exists(target.parent):
+                    Path.mkdir(target.parent, parents=True, exist_ok=True)
+                tools.copy_metered(source, target.parent)
+
+        if throttle is not None:
+            print(f'Copied at {throttle.report()}')
+
+def find_duplicates() -> None:
+    import dedupe
+
+    which = prompts.p_choice('Library to search', ['old', 'new'], allow_blank=True)
+    if which is None:
+        print('Cancelled')
+        return
+
+    old, new = get_libraries()
+    lib = old if which == 1 else new
+
+    print('Hashing album signatures...')
+    clusters = dedupe.find_clusters(list(lib.albums.values()), app.THRESHOLD_PROBABLE)
+    if not clusters:
+        print('No duplicates found')
+        return
+
+    for (e, links) in enumerate(clusters):
+        members = set()
+        for (a, b, _) in links:
+            members.update((a, b))
+
+        print(f'\n{e + 1}. {len(members)} albums')
+        for a in sorted(members):
+            print(f'    {a.path}')
+        for (a, b, score) in sorted(links, key=lambda link: link[2], reverse=True):
+            print(f'    {score:.3f}  {a.path.name}  ~  {b.path.name}')
+
+    print(f'\n{len(clusters)} clusters of near-duplicate albums')
+
+def watch_libraries() -> None:
+    if watch.is_watched(app.PATH_WATCH_HEARTBEAT, app.WATCH_STALE):
+        print('Another watcher is already running')
+        return
+
+    tags = TagCache(app.PATH_PICKLE_TAGS)
+    watchers = []
+    for (name, paths, path_pickle_legacy) in (
+        ('lib_old', app.PATHS_LIB_OLD, app.PATH_PICKLE_LIB_OLD),
+        ('lib_new', app.PATHS_LIB_NEW, app.PATH_PICKLE_LIB_NEW)):
+
+        for path in paths:
+            print(f'Catching up on {path}...')
+            root = load_root(name, path, path_pickle_legacy, tags=tags)
+            watchers.append(watch.RootWatcher(root, lambda root, name=name: save_root(name, root), tags, app.FAST_TAGS))
+
+    tags.save()
+
+    print('Watching for changes; hit Ctrl+C to stop')
+    watch.watch(watchers, app.PATH_WATCH_HEARTBEAT, settle=app.WATCH_SETTLE)
 
 def quit():
     exit() # LOL. (Why? So it can be a function object with a __name__)
 
+PROGRAMS = [
+    quit,
+    check_unknown_all,
+    check_unknown_newer,
+    check_unmatched,
+    find_track_escapees,
+    do_track_escapees,
+    distribute_album_matching,
+    distribute_escapee_matching,
+    stream_album_matching,
+    rerank_candidates,
+    print_decisions,
+    undo_decision,
+    update_decs_version,
+    delete_outdated_decs,
+    sync_cull,
+    find_duplicates,
+    watch_libraries
+]
+
+def run_program(program: callable) -> None:
+    try:
+        program()
+    finally:
+        # Durations read along the way, where a fast scan left them out
+        library.save_tag_cache()
+
 def run():
-    choices = [
-        quit,
-        check_unknown_all,
-        check_unknown_newer,
-        check_unmatched,
-        find_track_escapees,
-        do_track_escapees,
-        print_decisions,
-        undo_decision,
-        update_decs_version,
-        delete_outdated_decs,
-        sync_cull
-    ]
-
-    program = prompts.p_choice('Choose program', [c.__name__ for c in choices], allow_blank=True)
+    program = prompts.p_choice('Choose program', [c.__name__ for c in PROGRAMS], allow_blank=True)
     if program is not None:
-        choices[program - 1]()
+        run_program(PROGRAMS[program - 1])
 
 if __name__ == '__main__':
     app = App()
     app.load_configuration()
-    prompts.p_repeat_till_quit(run, c_phrase='run a program')
+
+    # python src/main.py PROGRAM runs that one program and skips the menu
+    if len(sys.argv) > 1:
+        programs = {c.__name__: c for c in PROGRAMS}
+        if sys.argv[1] not in programs:
+            print(f'Unknown program {sys.argv[1]}; choose from {", ".join(programs)}')
+        else:
+            run_program(programs[sys.argv[1]])
+    else:
+        prompts.p_repeat_till_quit(run, c_phrase='run a program')
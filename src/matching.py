@@ -1,8 +1,11 @@
 from __future__ import annotations
 from enum import Enum
+import heapq
 from numbers import Number
+from pathlib import Path
 from typing import Iterable
-from fuzzywuzzy import fuzz
+
+_fuzz = None # fuzzywuzzy.fuzz, imported on first use to keep startup fast
 
 class MatchState(Enum):
     UNKNOWN = 0
@@ -14,42 +17,168 @@ class MatchState(Enum):
 class Matchable:
     data: dict[str, object]
     weights: dict[str, int]
+    kinds: dict[str, type] = {} # What each field holds, where always the same; see compile_measure
     ts_seen: int
 
     def set_default_data(self: Matchable) -> None:
         raise NotImplementedError
 
+    def fill(self: Matchable) -> None:
+        """Read whatever a fast scan left out and scoring needs."""
+        pass
+
+# Decisions are saved with references to the tracks and albums they are about,
+# not the objects, which would drag their albums and every sibling along. The
+# references are looked up in whichever libraries were loaded last (see
+# use_libraries); until then, or if the file is gone, the reference stands in.
+
+KIND_ALBUM = 'album'
+KIND_TRACK = 'track'
+
+_libraries: dict[str, object] = {} # 'old' and 'new': the Library each side of a decision is found in
+
+def use_libraries(old: object, new: object) -> None:
+    _libraries['old'], _libraries['new'] = old, new
+
+def get_library(side: str) -> object:
+    return _libraries.get(side)
+
+class Ref:
+    """A track or album by its key in the library."""
+    kind: str
+    key: str
+
+    def __init__(self: Ref, kind: str, key: str) -> None:
+        self.kind, self.key = kind, key
+
+    @staticmethod
+    def to(m: Matchable | Ref) -> Ref:
+        if (m is None) or isinstance(m, Ref):
+            return m
+        return Ref(KIND_ALBUM if hasattr(m, 'tracks') else KIND_TRACK, str(m.path))
+
+    def __reduce__(self: Ref) -> tuple:
+        return Ref, (self.kind, self.key)
+
+    @property
+    def path(self: Ref) -> Path:
+        return Path(self.key)
+
+    @property
+    def tracks(self: Ref) -> dict[str, Matchable]:
+        # Not in the library, so nothing of it is left to match or cull
+        return {}
+
+    def present(self: Ref) -> str:
+        return f'{self.path.parent.name} / {self.path.name}'
+
+    def __str__(self: Ref) -> str:
+        return self.path.name
+
+def resolve(m: Matchable | Ref, side: str) -> Matchable | Ref:
+    if not isinstance(m, Ref):
+        return m
+
+    lib = get_library(side)
+    if lib is None:
+        return m
+
+    found = lib.albums.get(m.path) if m.kind == KIND_ALBUM else lib.tracks.get(m.key)
+    return m if found is None else found
+
+def get_omit_keys(old: Matchable | Ref, omit: object) -> list[str]:
+    """The keys of omitted tracks, from a dict by key or the lists older versions kept."""
+    if isinstance(omit, dict):
+        return list(omit)
+
+    keys = []
+    for v in omit:
+        if isinstance(v, str):
+            # The first decisions named omitted tracks by file stem
+            v = next((t for t in old.tracks.values() if t.path.stem == v), None)
+            if v is None:
+                continue
+        keys.append(str(v.path))
+    return keys
+
 class MatchDecision:
     old: Matchable
     new: Matchable
     state: MatchState
     score: float
     ts_made: int
-    omit: list[Matchable]
+    omit: dict[str, Matchable]
+    track_keys: list[str]
 
     def __init__(self: MatchDecision, old: Matchable, new: Matchable, state: MatchState, score: float, ts: int=0, omit: dict[str, Matchable]=[]) -> None:
         self.old, self.new = old, new
         self.state, self.score = state, score
         self.ts_made = ts
         self.omit = omit
+        self._keys = []
+
+    @property
+    def old(self: MatchDecision) -> Matchable:
+        return resolve(self._old, 'old')
+
+    @old.setter
+    def old(self: MatchDecision, m: Matchable) -> None:
+        self._old = m
+
+    @property
+    def new(self: MatchDecision) -> Matchable:
+        return resolve(self._new, 'new')
+
+    @new.setter
+    def new(self: MatchDecision, m: Matchable) -> None:
+        self._new = m
+
+    @property
+    def omit(self: MatchDecision) -> dict[str, Matchable]:
+        return {key: resolve(Ref(KIND_TRACK, key), 'old') for key in self._omit}
+
+    @omit.setter
+    def omit(self: MatchDecision, omit: object) -> None:
+        self._omit = get_omit_keys(self._old, omit)
+
+    @property
+    def track_keys(self: MatchDecision) -> list[str]:
+        """The keys of the old side's tracks, as last saved if it is no longer in the library."""
+        old = self.old
+        if isinstance(old, Ref):
+            return self._keys if old.kind == KIND_ALBUM else [old.key]
+        return list(old.tracks) if hasattr(old, 'tracks') else [str(old.path)]
+
+    @track_keys.setter
+    def track_keys(self: MatchDecision, keys: list[str]) -> None:
+        self._keys = keys
+
+    def __getstate__(self: MatchDecision) -> dict:
+        return {
+            'old': Ref.to(self._old), 'new': Ref.to(self._new), 'state': self.state,
+            'score': self.score, 'ts_made': self.ts_made, 'omit_keys': self._omit,
+            'track_keys': self.track_keys
+        }
+
+    def __setstate__(self: MatchDecision, state: dict) -> None:
+        self.state, self.score, self.ts_made = state['state'], state['score'], state.get('ts_made', 0)
+
+        # Decisions saved before references hold the objects themselves, and omit in whatever shape it had then
+        if 'omit_keys' in state:
+            self._omit = state['omit_keys']
+        else:
+            self._omit = get_omit_keys(state['old'], state.get('omit') or [])
+
+        # Kept so that an album gone from the library can still be accounted for by its tracks
+        self._keys = state['track_keys'] if 'track_keys' in state else list(getattr(state['old'], 'tracks', {}))
+
+        self._old, self._new = Ref.to(state['old']), Ref.to(state.get('new'))
 
     @staticmethod
     def remake(d: MatchDecision) -> MatchDecision:
-        omit = d.omit
-        omit2 = omit
-        if omit and not isinstance(omit, dict):
-            omit2 = {}
-
-            for v in omit:
-                if isinstance(v, str):
-                    for t in d.old.tracks.values():
-                        if t.path.stem == v:
-                            break
-                else:
-                    t = v
-                    
-            omit2[str(t.path)] = t
-        return MatchDecision(d.old, d.new, d.state, d.score, d.ts_made, omit2)
+        made = MatchDecision(d._old, d._new, d.state, d.score, d.ts_made, dict.fromkeys(d._omit))
+        made.track_keys = d.track_keys
+        return made
 
     def present(self: MatchDecision) -> str:
         # So hackish
@@ -82,6 +211,34 @@ class MatchDecision:
         else:
             return f'{self.old.present():<80} ? unknown match'
 
+class TopK:
+    """The k highest-scoring items pushed so far. Among equal scores, earlier items win."""
+    k: int
+    heap: list[tuple[float, int, object]]
+    n_seen: int
+
+    def __init__(self: TopK, k: int) -> None:
+        self.k = k
+        self.heap = []
+        self.n_seen = 0
+
+    def push(self: TopK, score: float, item: object) -> None:
+        # Min-heap, so the root is the entry to evict: lowest score, then latest arrival
+        entry = (score, -self.n_seen, item)
+        self.n_seen += 1
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def extend(self: TopK, scored: Iterable[tuple[float, object]]) -> None:
+        for (score, item) in scored:
+            self.push(score, item)
+
+    def results(self: TopK) -> list[tuple[float, object]]:
+        return [(score, item) for (score, _, item) in sorted(self.heap, key=lambda e: e[:2], reverse=True)]
+
 def measure_similarity(m1: Matchable, m2: Matchable) -> tuple[tuple[float], int]:
     stats = []
     denom = 0
@@ -99,8 +256,120 @@ def measure_similarity(m1: Matchable, m2: Matchable) -> tuple[tuple[float], int]
     return stats, denom
 
 def score_similarity(m1: Matchable, m2: Matchable) -> tuple[float, tuple[float], int]:       
+    m1.fill()
+    m2.fill()
+    scorer = _scorers.get(type(m1))
+    if scorer is None:
+        scorer = _scorers[type(m1)] = compile_scorer(m1.weights, m1.kinds)
+    return scorer(m1, m2)
+
+def score_similarity_generic(m1: Matchable, m2: Matchable) -> tuple[float, tuple[float], int]:
+    """score_similarity without the compiled scorer, dispatching on every value."""
+    m1.fill()
+    m2.fill()
     stats, denom = measure_similarity(m1, m2)
-    return sum(stats) / denom, stats, denom
+    return (sum(stats) / denom if denom else 0.0), stats, denom
+
+_scorers: dict[type, callable] = {}
+
+def compile_scorer(weights: dict[str, int], kinds: dict[str, type]) -> callable:
+    """A score_similarity for one schema: its raw measure (see compile_measure), weighed."""
+    measure = compile_measure(tuple(weights), kinds)
+    vector = tuple(weights.values())
+
+    def _score(m1: Matchable, m2: Matchable) -> tuple[float, tuple[float], int]:
+        return _weighed(measure(m1, m2), vector)
+
+    return _score
+
+def measure_raw(m1: Matchable, m2: Matchable) -> tuple[float]:
+    """Unweighted similarity of each field, in the order of m1.weights; None where either side lacks it."""
+    m1.fill()
+    m2.fill()
+    measure = _measurers.get(type(m1))
+    if measure is None:
+        measure = _measurers[type(m1)] = compile_measure(tuple(m1.weights), m1.kinds)
+    return measure(m1, m2)
+
+_measurers: dict[type, callable] = {}
+
+def compile_measure(fields: tuple[str], kinds: dict[str, type]) -> callable:
+    comparators = tuple((key, _comparator(kinds.get(key))) for key in fields)
+
+    def _measure(m1: Matchable, m2: Matchable) -> tuple[float]:
+        d1, d2 = m1.data, m2.data
+        raw = []
+        for (key, cmp) in comparators:
+            a, b = d1.get(key), d2.get(key)
+            raw.append(None if (a is None) or (b is None) else cmp(a, b))
+        return tuple(raw)
+
+    return _measure
+
+def weigh(raw: tuple[float], weights: tuple[int]) -> float:
+    """The score of a raw measure under weights given in the same field order."""
+    return _weighed(raw, weights)[0]
+
+def _weighed(raw: tuple[float], weights: tuple[int]) -> tuple[float, list[float], int]:
+    stats = []
+    denom = 0
+    for (n, d) in zip(raw, weights):
+        if n is not None:
+            stats.append(n * d)
+            denom += d
+
+    # Nothing both sides have that carries any weight: nothing to call them alike on
+    return (sum(stats) / denom if denom else 0.0), stats, denom
+
+def _comparator(kind: type) -> callable:
+    global _fuzz
+    if _fuzz is None:
+        from fuzzywuzzy import fuzz as _fuzz
+    SequenceMatcher = _fuzz.SequenceMatcher # Whichever fuzz.ratio uses
+
+    def _strings(a: str, b: str) -> float:
+        # fuzz.ratio, less the checks its decorators make on every call
+        if a == b:
+            return 1.0
+        if not (a and b):
+            return 0.0
+        return round(100 * SequenceMatcher(None, a, b).ratio()) / 100
+
+    def _numbers(a: Number, b: Number) -> float:
+        return a / b if a <= b else b / a
+
+    def _string_sets(a: Iterable, b: Iterable) -> float:
+        if 0 in {len(a), len(b)}:
+            return 0.0
+
+        score = 0.0
+        for a_sub in a:
+            score += max(_strings(a_sub, b_sub) for b_sub in b)
+        for b_sub in b:
+            score += max(_strings(b_sub, a_sub) for a_sub in a)
+        return score / (len(a) + len(b))
+
+    if kind is str:
+        return _strings
+    elif kind is Number:
+        return _numbers
+    elif kind is set:
+        return _string_sets
+    else:
+        return compare
+
+def find_best_match_strict(a: Matchable, pool: list[Matchable], threshold: float) -> tuple[Matchable, float]:
+    best = None
+    best_score = 0.0
+
+    for b in pool:
+        score, _, _ = score_similarity(a, b)
+
+        if (score >= threshold) and (score > best_score):
+            best = b
+            best_score = score
+
+    return best, best_score
 
 def compare(a: object, b: object) -> float:
     if isinstance(a, str):
@@ -115,7 +384,11 @@ def compare(a: object, b: object) -> float:
     return n
 
 def compare_strings(a: str, b: str) -> float:
-    return fuzz.ratio(a, b) / 100
+    global _fuzz
+    if _fuzz is None:
+        from fuzzywuzzy import fuzz as _fuzz
+
+    return _fuzz.ratio(a, b) / 100
 
 def compare_numbers(a: Number, b: Number) -> float:
     nums = sorted([a, b])    
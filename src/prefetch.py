@@ -0,0 +1,46 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class Prefetcher:
+    """
+    Works out results for the next few items on a background thread while
+    the current one waits on the user.
+    Arguments are captured when work is submitted, so pass snapshots of
+    anything the caller goes on to mutate.
+    """
+    compute: callable
+    futures: dict[object, Future]
+
+    def __init__(self: Prefetcher, compute: callable) -> None:
+        self.compute = compute
+        self.futures = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def ahead(self: Prefetcher, items: list[object], *args: object) -> None:
+        for item in items:
+            if item not in self.futures:
+                self.futures[item] = self.executor.submit(self.compute, item, *args)
+
+    def get(self: Prefetcher, item: object, *args: object, stale: callable=None) -> object:
+        """The prefetched result for item, unless missing or stale, in which case compute it now."""
+        f = self.futures.get(item)
+        if (f is None) or f.cancelled():
+            result = None
+        else:
+            result = f.result()
+
+        if (result is None) or ((stale is not None) and stale(result)):
+            result = self.compute(item, *args)
+            f = Future()
+            f.set_result(result)
+            self.futures[item] = f
+
+        return result
+
+    def forget(self: Prefetcher, item: object) -> None:
+        f = self.futures.pop(item, None)
+        if f is not None:
+            f.cancel()
+
+    def close(self: Prefetcher) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+import re
+
+# A keyword index over short texts. Every word is posted under itself, its
+# first one and two letters, and its trigrams, so that a query term of any
+# length narrows the candidates to a few postings before the texts are checked.
+
+RANK_WORD = 3
+RANK_PREFIX = 2
+RANK_SUBSTRING = 1
+
+def words(text: str) -> list[str]:
+    return re.findall(r'\w+', text.casefold())
+
+def terms(word: str) -> set[str]:
+    found = {f'w:{word}', f'p:{word[:1]}', f'p:{word[:2]}'}
+    for i in range(len(word) - 2):
+        found.add(f'g:{word[i:i + 3]}')
+    return found
+
+class SearchIndex:
+    """Maps keys to texts, and finds the keys whose texts contain every word of a query."""
+    texts: dict[object, str]
+    postings: dict[str, set[object]]
+
+    def __init__(self: SearchIndex) -> None:
+        self.texts = {}
+        self.postings = {}
+
+    def add(self: SearchIndex, key: object, text: str) -> None:
+        if key in self.texts:
+            self.remove(key)
+
+        self.texts[key] = text
+        for word in set(words(text)):
+            for term in terms(word):
+                self.postings.setdefault(term, set()).add(key)
+
+    def remove(self: SearchIndex, key: object) -> None:
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+
+        for word in set(words(text)):
+            for term in terms(word):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.discard(key)
+                    if not posting:
+                        del self.postings[term]
+
+    def sync(self: SearchIndex, texts: dict[object, str], kind: str) -> bool:
+        """Bring the keys of one kind (their first element) in line with texts. Return True if anything changed."""
+        stale = [key for key in self.texts if (key[0] == kind) and (self.texts[key] != texts.get(key))]
+        for key in stale:
+            self.remove(key)
+
+        fresh = [key for key in texts if key not in self.texts]
+        for key in fresh:
+            self.add(key, texts[key])
+
+        return bool(stale or fresh)
+
+    def sync_keys(self: SearchIndex, items: dict[object, object], describe: callable, kind: str) -> bool:
+        """As sync, for items whose text never changes under the same key: only new keys are described."""
+        stale = [key for key in self.texts if (key[0] == kind) and (key not in items)]
+        for key in stale:
+            self.remove(key)
+
+        fresh = [key for key in items if key not in self.texts]
+        for key in fresh:
+            self.add(key, describe(items[key]))
+
+        return bool(stale or fresh)
+
+    def candidates(self: SearchIndex, term: str) -> set[object]:
+        if len(term) < 3:
+            return self.postings.get(f'p:{term}', set())
+
+        found = None
+        for i in range(len(term) - 2):
+            posting = self.postings.get(f'g:{term[i:i + 3]}', set())
+            found = posting.copy() if found is None else found.intersection(posting)
+            if not found:
+                break
+        return found
+
+    def search(self: SearchIndex, query: str, kinds: tuple[str]=None, limit: int=None) -> list[object]:
+        """Keys matching every word of the query, whole words first, then prefixes, then anywhere."""
+        ranks = None
+        for term in set(words(query)):
+            found = {}
+            for key in self.candidates(term):
+                if (kinds is not None) and (key[0] not in kinds):
+                    continue
+
+                ws = words(self.texts[key])
+                if term in ws:
+                    found[key] = RANK_WORD
+                elif any(w.startswith(term) for w in ws):
+                    found[key] = RANK_PREFIX
+                elif any(term in w for w in ws):
+                    found[key] = RANK_SUBSTRING
+
+            if ranks is None:
+                ranks = found
+            else:
+                ranks = {key: ranks[key] + rank for (key, rank) in found.items() if key in ranks}
+
+            if not ranks:
+                return []
+
+        if ranks is None:
+            return []
+
+        results = sorted(ranks, key=lambda key: (-ranks[key], self.texts[key]))
+        return results if limit is None else results[:limit]
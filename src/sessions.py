@@ -0,0 +1,128 @@
+from __future__ import annotations
+from pathlib import Path
+from tools import _pickle, _unpickle
+import matching
+import threading
+import time
+import tools
+
+# Several people reviewing at once. Each session leases the albums it is
+# about to review, a batch at a time, so no two reviewers see the same one,
+# and merges its decisions into the shared file rather than overwriting it.
+# Leases and decisions are only read and written under one file lock. While
+# a session is open its leases are renewed in the background, so a reviewer
+# who sits at a prompt doesn't lose them.
+
+class ReviewSession:
+    reviewer: str
+    leases: dict[str, tuple[str, float]] # Old album key: reviewer and when the lease runs out
+    ts_start: int
+
+    def __init__(self: ReviewSession, reviewer: str, path_decisions: Path, path_leases: Path, path_lock: Path, lease: float=1_800.0, batch: int=20) -> None:
+        self.reviewer = reviewer
+        self.path_decisions = path_decisions
+        self.path_leases = path_leases
+        self.lock = tools.FileLock(path_lock)
+        self.lease_time = lease
+        self.batch = batch
+        self.held = set()
+        self.ts_start = tools.ts_now()
+        self.mutex = threading.Lock()
+        self.closed = threading.Event()
+        threading.Thread(target=self._renew_every, args=(lease / 3,), daemon=True).start()
+
+    def _stamp(self: ReviewSession, leases: dict[str, tuple[str, float]]) -> None:
+        """Extend the leases still this reviewer's; any another has taken over are no longer held."""
+        now = time.time()
+        for key in list(self.held):
+            reviewer, _ = leases.get(key, (None, 0.0))
+            if reviewer not in (None, self.reviewer):
+                self.held.discard(key)
+                continue
+            leases[key] = (self.reviewer, now + self.lease_time)
+
+    def renew(self: ReviewSession) -> None:
+        with self.mutex, self.lock:
+            if not self.held:
+                return
+            leases = _unpickle(self.path_leases, {})
+            self._stamp(leases)
+            _pickle(leases, self.path_leases)
+
+    def _renew_every(self: ReviewSession, interval: float) -> None:
+        while not self.closed.wait(interval):
+            self.renew()
+
+    def claim(self: ReviewSession, keys: object) -> tuple[set[str], set[str], set[str]]:
+        """
+        Lease the next batch of keys that nobody else holds or has decided since
+        this session began. Returns the keys now held, keys others hold, and the
+        paths of new albums others have matched since this session began.
+        """
+        claimed, busy = set(), set()
+        now = time.time()
+
+        with self.mutex, self.lock:
+            decs = _unpickle(self.path_decisions, [])
+            leases = _unpickle(self.path_leases, {})
+
+            decided, taken = set(), set()
+            for dec in decs:
+                if dec.ts_made > self.ts_start:
+                    decided.add(str(dec.old.path))
+                    if dec.state in (matching.MatchState.MATCHED, matching.MatchState.PARTIAL):
+                        taken.add(str(dec.new.path))
+
+            for key in keys:
+                if len(claimed) == self.batch:
+                    break
+
+                if key in decided:
+                    continue
+
+                reviewer, ts_expires = leases.get(key, (None, 0.0))
+                if (reviewer not in (None, self.reviewer)) and (ts_expires > now):
+                    busy.add(key)
+                    continue
+
+                claimed.add(key)
+
+            # Claimed keys may have lapsed from another reviewer, so take them over before renewing
+            for key in claimed:
+                leases[key] = (self.reviewer, now + self.lease_time)
+            self.held.update(claimed)
+            self._stamp(leases)
+            _pickle(leases, self.path_leases)
+
+        return claimed, busy, taken
+
+    def save(self: ReviewSession, mine: list[matching.MatchDecision]) -> list[matching.MatchDecision]:
+        """Add this session's decisions to the shared ones, give up their leases, and return the lot."""
+        with self.mutex, self.lock:
+            decs = _unpickle(self.path_decisions, [])
+            decs.extend(mine)
+            _pickle(decs, self.path_decisions)
+
+            leases = _unpickle(self.path_leases, {})
+            for dec in mine:
+                key = str(dec.old.path)
+                self.held.discard(key)
+                if leases.get(key, (None,))[0] == self.reviewer:
+                    del leases[key]
+            self._stamp(leases)
+            _pickle(leases, self.path_leases)
+
+        mine.clear()
+        return decs
+
+    def close(self: ReviewSession) -> None:
+        """Hand back every lease still held."""
+        self.closed.set()
+        with self.mutex, self.lock:
+            leases = _unpickle(self.path_leases, {})
+            for key in self.held:
+                if leases.get(key, (None,))[0] == self.reviewer:
+                    del leases[key]
+            _pickle(leases, self.path_leases)
+
+        self.held.clear()
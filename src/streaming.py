@@ -0,0 +1,161 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+from columnar import Store, KIND_STR
+from library import Album
+import json
+import mmap
+import os
+import re
+import struct
+
+# An on-disk index from blocking tokens (album artists and folder-name words)
+# to the new library's albums, for matching without holding the library in
+# memory. Albums are referred to by (root << 32) | album, where root is the
+# position of the new root's columnar cache and album its row there.
+#
+#   magic, header length, header (JSON: stamp, n_tokens, sections)
+#   tokens.offsets, tokens.blob        the tokens, sorted
+#   postings.start, postings.refs      the albums for token i are refs[start[i]:start[i + 1]]
+
+MAGIC = b'MICI0001'
+MAX_POSTING = 5_000 # Tokens shared by more albums than this don't narrow anything down
+
+def tokens(artists: set[str], folder_name: str) -> set[str]:
+    found = set(f'a:{artist}' for artist in artists if artist)
+    for word in re.findall(r'\w+', folder_name.casefold()):
+        if len(word) > 1:
+            found.add(f'w:{word}')
+    return found
+
+def album_tokens(a: Album) -> set[str]:
+    return tokens(a.data['albumartists'], a.path.name)
+
+def stored_album_tokens(store: Store, j: int) -> set[str]:
+    """As album_tokens, read straight from the columns without building the album."""
+    cols = store.cols
+    kinds, values = cols['tracks.albumartist.kind'], cols['tracks.albumartist.value']
+
+    artists = set()
+    for i in range(cols['albums.start'][j], cols['albums.stop'][j]):
+        if kinds[i] == KIND_STR:
+            artists.add(store.string(int(values[i])))
+
+    return tokens(artists, Path(store.string(cols['albums.path'][j])).name)
+
+def get_stamp(paths: list[Path]) -> str:
+    """Identifies the exact cache files an index was built from."""
+    parts = []
+    for path in paths:
+        stat = path.stat()
+        parts.append(f'{path}|{stat.st_size}|{stat.st_mtime_ns}')
+    return '\n'.join(parts)
+
+def build(stores: list[Store], path: Path, stamp: str) -> None:
+    postings = {}
+    for (r, store) in enumerate(stores):
+        for j in range(store.header['n_albums']):
+            for token in stored_album_tokens(store, j):
+                postings.setdefault(token, array('q')).append((r << 32) | j)
+
+    keys = sorted(postings)
+    blobs = [k.encode('utf-8', 'surrogateescape') for k in keys]
+
+    offsets, starts, refs = array('q', [0]), array('q', [0]), array('q')
+    for (k, b) in zip(keys, blobs):
+        offsets.append(offsets[-1] + len(b))
+        refs.extend(postings[k])
+        starts.append(len(refs))
+    del postings
+
+    sections = {'tokens.offsets': offsets, 'tokens.blob': b''.join(blobs), 'postings.start': starts, 'postings.refs': refs}
+    layout, position = {}, 0
+    for (name, data) in sections.items():
+        n_bytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = (position, n_bytes, data.typecode if isinstance(data, array) else 'B')
+        position += _pad(n_bytes)
+
+    header = json.dumps({'stamp': stamp, 'n_tokens': len(keys), 'sections': layout}).encode()
+    start = _pad(len(MAGIC) + 8 + len(header))
+
+    path_tmp = Path(f'{path}.tmp')
+    with open(path_tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (start - f.tell()))
+
+        for (name, data) in sections.items():
+            _, n_bytes, _ = layout[name]
+            f.write(data.tobytes() if isinstance(data, array) else data)
+            f.write(b'\0' * (_pad(n_bytes) - n_bytes))
+
+    os.replace(path_tmp, path)
+
+def _pad(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+class CandidateIndex:
+    """A built index, mapped rather than read in."""
+
+    def __init__(self: CandidateIndex, path: Path) -> None:
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.mm.close()
+            raise ValueError(f'{path} is not a candidate index')
+
+        (n_header,) = struct.unpack_from('<q', self.mm, len(MAGIC))
+        self.header = json.loads(self.mm[len(MAGIC) + 8:len(MAGIC) + 8 + n_header])
+        start = _pad(len(MAGIC) + 8 + n_header)
+
+        self.views = [memoryview(self.mm)]
+        self.cols = {}
+        for (name, (offset, n_bytes, typecode)) in self.header['sections'].items():
+            raw = self.views[0][start + offset:start + offset + n_bytes]
+            self.cols[name] = raw.cast(typecode)
+            self.views.extend((raw, self.cols[name]))
+
+    @staticmethod
+    def open(path: Path, stores: list[Store], paths: list[Path]) -> CandidateIndex:
+        """The index at path, rebuilt first if the caches it was built from have changed."""
+        stamp = get_stamp(paths)
+        if Path.exists(path):
+            index = CandidateIndex(path)
+            if index.header['stamp'] == stamp:
+                return index
+            index.close()
+
+        build(stores, path, stamp)
+        return CandidateIndex(path)
+
+    def token(self: CandidateIndex, i: int) -> str:
+        offsets = self.cols['tokens.offsets']
+        return bytes(self.cols['tokens.blob'][offsets[i]:offsets[i + 1]]).decode('utf-8', 'surrogateescape')
+
+    def postings(self: CandidateIndex, token: str) -> memoryview:
+        n = self.header['n_tokens']
+        i = bisect_left(range(n), token, key=self.token)
+        if (i == n) or (self.token(i) != token):
+            return self.cols['postings.refs'][0:0]
+
+        starts = self.cols['postings.start']
+        return self.cols['postings.refs'][starts[i]:starts[i + 1]]
+
+    def candidates(self: CandidateIndex, tokens: set[str], n: int) -> list[int]:
+        """The n albums sharing the most tokens with the given ones."""
+        counts = Counter()
+        for token in tokens:
+            refs = self.postings(token)
+            if len(refs) <= MAX_POSTING:
+                counts.update(refs)
+        return [ref for (ref, _) in counts.most_common(n)]
+
+    def close(self: CandidateIndex) -> None:
+        for view in reversed(self.views):
+            view.release()
+        self.cols = {}
+        self.mm.close()
@@ -1,11 +1,47 @@
 
+from __future__ import annotations
 import datetime
+import hashlib
+import io
+import os
 import pickle
 from pathlib import Path
 
 def _pickle(o: object, path: Path) -> None:
-    with open(path, 'wb') as f:
+    # Write aside and swap in, so a concurrent reader never sees half a pickle
+    path_tmp = Path(f'{path}.tmp')
+    with open(path_tmp, 'wb') as f:
         pickle.dump(o, f)
+    os.replace(path_tmp, path)
+
+class Spill:
+    """
+    Records appended to a file a batch at a time and read back in order, to keep
+    what a long run produces out of memory until it is merged at the end.
+    """
+
+    def __init__(self: Spill, path: Path) -> None:
+        self.path = path
+        self.f = open(path, 'wb')
+        self.n = 0
+
+    def write(self: Spill, records: list) -> None:
+        pickle.dump(records, self.f)
+        self.n += len(records)
+
+    def __iter__(self: Spill):
+        self.f.close()
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    records = pickle.load(f)
+                except EOFError:
+                    return
+                yield from records
+
+    def close(self: Spill) -> None:
+        self.f.close()
+        Path.unlink(self.path, missing_ok=True)
 
 def _unpickle(path: Path, default: object=None) -> object:
     if Path.exists(path):
@@ -14,6 +50,335 @@ def _unpickle(path: Path, default: object=None) -> object:
     else:
         return default
 
+class FileLock:
+    """
+    A lock between processes, even on other machines sharing the drive, held
+    by creating a file. The holder keeps the file's mtime fresh, so a lock file
+    older than stale seconds is presumed abandoned. The file names its holder,
+    so nobody releases a lock they no longer hold.
+    """
+
+    def __init__(self: FileLock, path: Path, stale: float=60.0, poll: float=0.1) -> None:
+        self.path = path
+        self.stale = stale
+        self.poll = poll
+        self.token = None
+        self.released = None
+
+    def _owner(self: FileLock, path: Path=None) -> str:
+        try:
+            with open(path or self.path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def __enter__(self: FileLock) -> FileLock:
+        import socket
+        import threading
+        import time
+        import uuid
+
+        token = f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}'
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token.encode())
+                os.close(fd)
+                break
+
+            except FileExistsError:
+                if not self._break_stale():
+                    time.sleep(self.poll)
+
+        self.token = token
+        self.released = threading.Event()
+        threading.Thread(target=self._refresh, args=(token, self.released), daemon=True).start()
+        return self
+
+    def _refresh(self: FileLock, token: str, released: object) -> None:
+        # A slow holder mustn't look like a dead one
+        while not released.wait(self.stale / 4):
+            if self._owner() != token:
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def _break_stale(self: FileLock) -> bool:
+        """Take away an abandoned lock file. True if there may be no lock now."""
+        import time
+        import uuid
+
+        try:
+            if time.time() - os.path.getmtime(self.path) <= self.stale:
+                return False
+            token = self._owner()
+
+            # Only one waiter can move the file aside, so only one breaks it
+            aside = Path(f'{self.path}.{uuid.uuid4().hex}.stale')
+            os.rename(self.path, aside)
+        except FileNotFoundError:
+            return True
+
+        # Another waiter broke it first and has since taken the lock: give it back
+        if self._owner(aside) != token:
+            try:
+                os.link(aside, self.path)
+            except OSError:
+                pass
+        Path.unlink(aside, missing_ok=True)
+        return True
+
+    def __exit__(self: FileLock, *exc: object) -> None:
+        self.released.set()
+        if self._owner() == self.token:
+            Path.unlink(self.path, missing_ok=True)
+        self.token = None
+
+class TokenBucket:
+    """
+    Lets rate units a second through, in bursts of up to burst, shared by any
+    number of threads. Takers may overdraw; whoever does waits off the debt.
+    """
+
+    def __init__(self: TokenBucket, rate: float, burst: float=None) -> None:
+        import threading
+        import time
+
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self: TokenBucket, n: float) -> None:
+        import time
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+
+_throttle: Throttle = None # The one in effect, if any; see Throttle.__enter__
+
+class Throttle:
+    """
+    Limits on bytes and files a second for one job, 0 meaning none, and what the
+    job actually achieved. While in effect, open_metered and copy_metered count
+    against it and take_file counts a file.
+    """
+
+    def __init__(self: Throttle, bytes_per_sec: float=0, files_per_sec: float=0) -> None:
+        import threading
+        import time
+
+        self.bytes_per_sec, self.files_per_sec = bytes_per_sec, files_per_sec
+        # Bursts of a quarter of a second; a read bigger than that just waits longer
+        self.bytes = TokenBucket(bytes_per_sec, bytes_per_sec / 4) if bytes_per_sec else None
+        self.files = TokenBucket(files_per_sec, max(files_per_sec / 4, 1)) if files_per_sec else None
+        self.n_bytes, self.n_files = 0, 0
+        self.ts_start = time.monotonic()
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def read(self: Throttle, n: int) -> None:
+        with self.lock:
+            self.n_bytes += n
+        if self.bytes is not None:
+            self.bytes.take(n)
+
+    def file(self: Throttle) -> None:
+        with self.lock:
+            self.n_files += 1
+        if self.files is not None:
+            self.files.take(1)
+
+    def report(self: Throttle) -> str:
+        import time
+
+        secs = max(time.monotonic() - self.ts_start, 1e-6)
+        allowed_bytes = f'{format_bytes(self.bytes_per_sec)}/s' if self.bytes_per_sec else 'unlimited'
+        allowed_files = f'{self.files_per_sec:.0f}' if self.files_per_sec else 'unlimited'
+        return f'{format_bytes(self.n_bytes / secs)}/s of {allowed_bytes}, {self.n_files / secs:.0f} files/s of {allowed_files}'
+
+    def __enter__(self: Throttle) -> Throttle:
+        global _throttle
+        import time
+
+        self.previous, _throttle = _throttle, self
+        self.ts_start = time.monotonic()
+        return self
+
+    def __exit__(self: Throttle, *exc: object) -> None:
+        global _throttle
+        _throttle = self.previous
+
+def limit_io(bytes_per_sec: float, files_per_sec: float) -> Throttle:
+    """A throttle with these limits or, if there are none, a context that leaves reads alone."""
+    from contextlib import nullcontext
+
+    if bytes_per_sec or files_per_sec:
+        return Throttle(bytes_per_sec, files_per_sec)
+    return nullcontext()
+
+class _MeteredReader(io.RawIOBase):
+    """Wraps a raw file so that every read counts against a throttle."""
+
+    def __init__(self: _MeteredReader, f: io.RawIOBase, throttle: Throttle) -> None:
+        self.f = f
+        self.throttle = throttle
+
+    def readable(self: _MeteredReader) -> bool:
+        return True
+
+    def seekable(self: _MeteredReader) -> bool:
+        return True
+
+    def seek(self: _MeteredReader, offset: int, whence: int=os.SEEK_SET) -> int:
+        return self.f.seek(offset, whence)
+
+    def tell(self: _MeteredReader) -> int:
+        return self.f.tell()
+
+    def readinto(self: _MeteredReader, b: bytearray) -> int:
+        n = self.f.readinto(b)
+        if n:
+            self.throttle.read(n)
+        return n
+
+    def close(self: _MeteredReader) -> None:
+        self.f.close()
+        super().close()
+
+def open_metered(path: Path) -> io.BufferedIOBase:
+    """Open path for binary reading, counted against the throttle in effect, if any."""
+    if _throttle is None:
+        return open(path, 'rb')
+    return io.BufferedReader(_MeteredReader(open(path, 'rb', buffering=0), _throttle))
+
+def copy_metered(source: Path, dir_target: Path, chunk: int=1_048_576) -> None:
+    """shutil.copy2, but counted against the throttle in effect, if any."""
+    import shutil
+
+    if _throttle is None:
+        shutil.copy2(source, dir_target)
+        return
+
+    _throttle.file()
+    target = Path(dir_target) / Path(source).name
+    with open_metered(source) as f_in, open(target, 'wb') as f_out:
+        while data := f_in.read(chunk):
+            f_out.write(data)
+    shutil.copystat(source, target)
+
+def take_file() -> None:
+    """Count a file against the throttle in effect, if any."""
+    if _throttle is not None:
+        _throttle.file()
+
+def make_io_bar(max_value: int=None) -> object:
+    """A progress bar that also shows how the throttle in effect, if any, is doing."""
+    import progressbar
+
+    bar = progressbar.ProgressBar(max_value=max_value)
+    if _throttle is not None:
+        throttle = _throttle
+
+        class _Rate(progressbar.widgets.WidgetBase):
+            def __call__(self: _Rate, progress: object, data: object) -> str:
+                return f' {throttle.report()}'
+
+        bar = progressbar.ProgressBar(max_value=max_value, widgets=bar.default_widgets() + [_Rate()])
+    return bar
+
+IO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+class IOPriority:
+    """
+    Run a block at an I/O scheduling class (realtime, best-effort or idle) via
+    ionice, where there is one, and put the old class back after. Threads started
+    inside the block inherit it; threads already running keep theirs.
+    """
+
+    said: set[str] = set() # Warnings already printed this run; every scan and cull would repeat them
+
+    def __init__(self: IOPriority, name: str=None) -> None:
+        self.name = name
+        self.previous = None
+
+    @classmethod
+    def _say_once(cls: type, message: str) -> None:
+        if message not in cls.said:
+            cls.said.add(message)
+            print(message)
+
+    def _ionice(self: IOPriority, *args: str) -> str:
+        import subprocess
+        result = subprocess.run(['ionice', *args, '-p', str(os.getpid())], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise OSError(result.stderr.strip())
+        return result.stdout.strip()
+
+    def __enter__(self: IOPriority) -> IOPriority:
+        import shutil
+
+        if self.name is None:
+            return self
+        if self.name not in IO_CLASSES:
+            self._say_once(f'Unknown I/O priority {self.name}, ignoring it; use one of {", ".join(IO_CLASSES)}')
+            return self
+        if shutil.which('ionice') is None:
+            self._say_once(f'No ionice here, so I/O priority {self.name} is ignored')
+            return self
+
+        try:
+            self.previous = self._ionice() # e.g. 'best-effort: prio 4'
+            self._ionice('-c', str(IO_CLASSES[self.name]))
+        except OSError as e:
+            print(f'Could not set I/O priority {self.name}: {e}')
+            self.previous = None
+        return self
+
+    def __exit__(self: IOPriority, *exc: object) -> None:
+        if self.previous is None:
+            return
+
+        name, _, prio = self.previous.partition(': prio ')
+        args = ['-c', str(IO_CLASSES.get(name, 0))]
+        if IO_CLASSES.get(name) in (1, 2) and prio:
+            args += ['-n', prio]
+        try:
+            self._ionice(*args)
+        except OSError as e:
+            print(f'Could not restore I/O priority {self.previous}: {e}')
+
+def format_bytes(n: float) -> str:
+    if n >= 2 ** 20:
+        return f'{n / 2 ** 20:.1f} MB'
+    return f'{n / 2 ** 10:.0f} KB'
+
+def parse_size(s: str) -> int:
+    """Bytes from e.g. 512, 64K, 20M or 1G."""
+    s = s.strip().upper()
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(float(s))
+
+def rss_mb() -> float:
+    """Memory this process holds, in MB, or None where the OS doesn't say."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
 def get_filepaths(path_base: Path, exts: list[str]=[]) -> set[Path]:
     result = set()
     for path in Path.rglob(path_base, '*'):
@@ -21,6 +386,164 @@ def get_filepaths(path_base: Path, exts: list[str]=[]) -> set[Path]:
             result.add(path)
     return result
 
+def get_filepaths_concurrent(path_base: Path, exts: list[str]=[], concurrency: int=16) -> set[Path]:
+    """As get_filepaths, but with up to concurrency directory listings in flight, for high-latency shares."""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    result = set()
+
+    async def _walk(pool: ThreadPoolExecutor, path: Path) -> None:
+        entries = await asyncio.get_running_loop().run_in_executor(pool, _list_dir, path)
+
+        subdirs = []
+        for (found, is_dir) in entries:
+            if is_dir:
+                subdirs.append(found)
+            elif (not exts) or (found.suffix.strip('.').lower() in exts):
+                result.add(found)
+
+        await asyncio.gather(*(_walk(pool, sub) for sub in subdirs))
+
+    async def _main() -> None:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            await _walk(pool, path_base)
+
+    asyncio.run(_main())
+    return result
+
+def _list_dir(path: Path) -> list[tuple[Path, bool]]:
+    # As rglob does, pass over folders that can't be read or are gone by now, rather than stop the walk
+    try:
+        with os.scandir(path) as it:
+            return [(Path(e.path), e.is_dir(follow_symlinks=False)) for e in it]
+    except OSError as e:
+        print(f'Skipping {path}: {e}')
+        return []
+
+def order_for_disk(paths: set[Path], physical: bool=False) -> list[list[Path]]:
+    """
+    The paths in batches, one per folder, in roughly the order they lie on disk:
+    by inode, which filesystems tend to hand out in allocation order, or with
+    physical by the block of each file's first extent where Linux will say.
+    """
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(path.parent, []).append(path)
+
+    keyed = []
+    for (par, members) in by_dir.items():
+        inodes = _inodes(par)
+
+        def _where(path: Path) -> tuple:
+            block = get_first_block(path) if physical else None
+            return (block is None, block or 0, inodes.get(path.name, 0), path.name)
+
+        members.sort(key=_where)
+        keyed.append(((_where(members[0]), str(par)), members))
+
+    keyed.sort(key=lambda pair: pair[0])
+    return [members for (_, members) in keyed]
+
+def _inodes(path: Path) -> dict[str, int]:
+    # One listing per folder rather than a stat per file
+    try:
+        with os.scandir(path) as it:
+            return {e.name: e.inode() for e in it}
+    except OSError:
+        return {}
+
+FS_IOC_FIEMAP = 0xC020660B
+
+def get_first_block(path: Path) -> int:
+    """Physical byte offset of the file's first extent, or None where FIEMAP isn't available."""
+    try:
+        import fcntl
+        import struct
+    except ImportError:
+        return None
+
+    # struct fiemap asking for one extent, followed by room for it
+    buf = bytearray(struct.pack('=QQIIII', 0, 0xFFFF_FFFF_FFFF_FFFF, 0, 0, 1, 0) + bytes(56))
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+
+    (n_mapped,) = struct.unpack_from('=I', buf, 20)
+    if not n_mapped:
+        return None
+    (physical,) = struct.unpack_from('=Q', buf, 40)
+    return physical
+
+def map_concurrent(f: callable, items: list, concurrency: int=16, on_done: callable=None) -> dict:
+    """{item: f(item)} with up to concurrency calls in flight; on_done(n) is called as they finish."""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def _main() -> dict:
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+
+            async def _one(item: object) -> tuple[object, object]:
+                return item, await loop.run_in_executor(pool, f, item)
+
+            results = {}
+            for future in asyncio.as_completed([_one(item) for item in items]):
+                item, v = await future
+                results[item] = v
+                if on_done is not None:
+                    on_done(len(results))
+
+            return results
+
+    return asyncio.run(_main())
+
+def digest_file(path: Path, sample: int=65_536) -> str:
+    """Hash the size plus the first and last sample bytes: cheap, but enough to tell files apart."""
+    h = hashlib.blake2b(digest_size=16)
+    with open_metered(path) as f:
+        size = f.seek(0, os.SEEK_END)
+        h.update(str(size).encode())
+
+        f.seek(0)
+        h.update(f.read(sample))
+        if size > sample:
+            f.seek(max(sample, size - sample))
+            h.update(f.read(sample))
+
+    return h.hexdigest()
+
+class BoundedReader(io.RawIOBase):
+    """Wraps a binary file so that it reports end of file once max_bytes have been read."""
+
+    def __init__(self: BoundedReader, f: io.BufferedIOBase, max_bytes: int) -> None:
+        self.f = f
+        self.remaining = max_bytes
+
+    def readable(self: BoundedReader) -> bool:
+        return True
+
+    def seekable(self: BoundedReader) -> bool:
+        return True
+
+    def seek(self: BoundedReader, offset: int, whence: int=os.SEEK_SET) -> int:
+        return self.f.seek(offset, whence)
+
+    def tell(self: BoundedReader) -> int:
+        return self.f.tell()
+
+    def readinto(self: BoundedReader, b: bytearray) -> int:
+        n = min(len(b), self.remaining)
+        if n <= 0:
+            return 0
+
+        data = self.f.read(n)
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
 def normalize_title(s: str) -> str:
     s = str(s)
 
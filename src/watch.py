@@ -0,0 +1,152 @@
+from __future__ import annotations
+from pathlib import Path
+from library import LibraryRoot, TagCache, EXTS
+import threading
+import time
+import tools
+
+class RootWatcher:
+    """Collects filesystem events for one root until they can be applied as a batch."""
+    root: LibraryRoot
+    save: callable
+    tags: TagCache
+    fast: bool
+    pending_new: set[Path]
+    pending_deleted: set[Path]
+    ts_last_event: float
+
+    def __init__(self: RootWatcher, root: LibraryRoot, save: callable, tags: TagCache=None, fast: bool=False) -> None:
+        self.root = root
+        self.save = save
+        self.tags = tags
+        self.fast = fast
+        self.pending_new = set()
+        self.pending_deleted = set()
+        self.ts_last_event = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_music(path: Path) -> bool:
+        return path.suffix.strip('.').lower() in EXTS
+
+    def touch(self: RootWatcher, path: Path) -> None:
+        if self.is_music(path):
+            self.pending_new.add(path)
+
+    def forget(self: RootWatcher, path: Path) -> None:
+        self.pending_new.discard(path)
+        self.pending_deleted.add(path)
+
+    def forget_dir(self: RootWatcher, path: Path) -> None:
+        for key in list(self.root.tracks):
+            if Path(key).is_relative_to(path):
+                self.forget(Path(key))
+
+    def touch_dir(self: RootWatcher, path: Path) -> None:
+        for found in tools.get_filepaths(path, exts=EXTS):
+            self.touch(found)
+
+    def dispatch(self: RootWatcher, event: object) -> None:
+        """Called by the watchdog observer for every event."""
+        if event.event_type not in ('created', 'modified', 'deleted', 'moved'):
+            return
+
+        src = Path(event.src_path)
+
+        with self.lock:
+            self.ts_last_event = time.monotonic()
+
+            if event.event_type == 'moved':
+                dest = Path(event.dest_path)
+                if event.is_directory:
+                    self.forget_dir(src)
+                    self.touch_dir(dest)
+                else:
+                    self.forget(src)
+                    self.touch(dest)
+
+            elif event.event_type == 'deleted':
+                if event.is_directory:
+                    self.forget_dir(src)
+                else:
+                    self.forget(src)
+
+            elif event.is_directory:
+                # Files copied in with a folder can land before the folder is watched
+                if event.event_type == 'created':
+                    self.touch_dir(src)
+
+            else:
+                self.touch(src)
+
+    def flush(self: RootWatcher, settle: float) -> bool:
+        """Apply pending events once they have been quiet for settle seconds."""
+        with self.lock:
+            if not (self.pending_new or self.pending_deleted):
+                return False
+            if time.monotonic() - self.ts_last_event < settle:
+                return False
+
+            new, deleted = self.pending_new, self.pending_deleted
+            self.pending_new, self.pending_deleted = set(), set()
+
+            # Net effect of the burst: rewritten tracks are forgotten and read again
+            known = self.root.tracks
+            rewritten = set(p for p in new if str(p) in known)
+            deleted = set(p for p in deleted if (str(p) in known) and (not Path.exists(p)))
+            deleted.update(rewritten)
+            new = set(p for p in new if Path.exists(p))
+
+            if not self.root.update(new, deleted, verbose=False, tags=self.tags, fast=self.fast):
+                return False
+
+        print(f'{self.root.path_base}: {len(new)} memorized, {len(deleted)} forgotten')
+        self.save(self.root)
+        if self.tags is not None:
+            self.tags.save()
+        return True
+
+def watch(watchers: list[RootWatcher], path_heartbeat: Path, settle: float=2.0, heartbeat: float=10.0) -> None:
+    """Keep the given roots and their caches current until interrupted."""
+    # watchdog is only needed for watch mode; it uses inotify on Linux
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        raise RuntimeError('Watch mode needs the watchdog package')
+
+    observer = Observer()
+    for w in watchers:
+        observer.schedule(w, str(w.root.path_base), recursive=True)
+    observer.start()
+
+    ts_beat = 0.0
+    try:
+        while True:
+            for w in watchers:
+                w.flush(settle)
+
+            if time.monotonic() - ts_beat >= heartbeat:
+                path_heartbeat.write_text(str(tools.ts_now()))
+                ts_beat = time.monotonic()
+
+            time.sleep(min(settle, heartbeat) / 4)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        observer.stop()
+        observer.join()
+        Path.unlink(path_heartbeat, missing_ok=True)
+
+def is_watched(path_heartbeat: Path, stale: float) -> bool:
+    """True if a watcher has reported in within the last stale seconds."""
+    if not Path.exists(path_heartbeat):
+        return False
+
+    try:
+        ts = int(path_heartbeat.read_text())
+    except ValueError:
+        return False
+
+    return (tools.ts_now() - ts) < stale * 1_000
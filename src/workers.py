@@ -0,0 +1,94 @@
+from __future__ import annotations
+from pathlib import Path
+from features import FeatureTable
+from library import Album, Track
+import matching
+
+# Process pool workers. Each worker receives the candidate pool once, at
+# startup, and afterwards only the chunks of work it is asked to score.
+# Local workers instead map feature tables written by the parent and are
+# sent row ranges, so nothing but indices crosses between processes.
+
+_pool: list[matching.Matchable] = []
+_threshold: float = 0.0
+_n: int = 10
+_old: FeatureTable = None
+_new: FeatureTable = None
+
+def init_pool(pool: list[matching.Matchable], threshold: float, n: int=10) -> None:
+    global _pool, _threshold, _n
+    _pool = pool
+    _threshold = threshold
+    _n = n
+
+def init_tables(path_old: Path, path_new: Path, threshold: float, n: int=10) -> None:
+    global _old, _new, _threshold, _n
+    _old = FeatureTable(path_old)
+    _new = FeatureTable(path_new)
+    _threshold = threshold
+    _n = n
+
+def find_escapees_range(start: int, stop: int, since: int=0) -> tuple[dict[str, tuple[str, float]], list[str]]:
+    """As find_escapees, for rows start to stop of the old table against the new one."""
+    chunk = [_old.row(i) for i in range(start, stop)]
+    bests = [(None, 0.0)] * len(chunk)
+
+    # Each new row is built once per range and scored against the whole chunk
+    for j in range(len(_new)):
+        if since and (_new.ts_seen(j) <= since):
+            continue
+
+        b = _new.row(j)
+        for (k, a) in enumerate(chunk):
+            score, _, _ = matching.score_similarity(a, b)
+            if (score >= _threshold) and (score > bests[k][1]):
+                bests[k] = (b, score)
+
+    found = {}
+    for (a, (best, score)) in zip(chunk, bests):
+        if best is not None:
+            found[str(a.path)] = (str(best.path), score)
+
+    return found, [str(a.path) for a in chunk]
+
+def find_escapees(chunk: list[Track], since: int=0) -> tuple[dict[str, tuple[str, float]], list[str]]:
+    """
+    Return the best new track (by key) for each old track that has one, and the keys searched.
+    Only new tracks first seen after since are considered.
+    """
+    pool = [b for b in _pool if b.ts_seen > since] if since else _pool
+
+    found = {}
+    for a in chunk:
+        best, score = matching.find_best_match_strict(a, pool, _threshold)
+        if best is not None:
+            found[str(a.path)] = (str(best.path), score)
+
+    return found, [str(a.path) for a in chunk]
+
+def find_album_candidates(chunk: list[Album]) -> tuple[dict[str, list[tuple[float, str, tuple[float]]]], list[str]]:
+    """Return the top candidates (by key, with their raw measures) for each album, and the keys searched."""
+    found = {}
+    for a in chunk:
+        top = matching.TopK(_n)
+        top.extend((matching.score_similarity(a, b)[0], b) for b in _pool)
+        found[str(a.path)] = [(score, str(b.path), matching.measure_raw(a, b)) for (score, b) in top.results()]
+
+    return found, [str(a.path) for a in chunk]
+
+def find_album_candidates_range(start: int, stop: int) -> tuple[dict[str, list[tuple[float, str, tuple[float]]]], list[str]]:
+    """As find_album_candidates, for rows start to stop of the old table against the new one."""
+    chunk = [_old.row(i) for i in range(start, stop)]
+    tops = [matching.TopK(_n) for _ in chunk]
+
+    # As with escapees, each new row is built once per range
+    for j in range(len(_new)):
+        b = _new.row(j)
+        for (a, top) in zip(chunk, tops):
+            top.push(matching.score_similarity(a, b)[0], b)
+
+    found = {}
+    for (a, top) in zip(chunk, tops):
+        found[str(a.path)] = [(score, str(b.path), matching.measure_raw(a, b)) for (score, b) in top.results()]
+
+    return found, [str(a.path) for a in chunk]
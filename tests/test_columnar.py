@@ -0,0 +1,71 @@
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import columnar
+from library import Album, LibraryRoot, Track
+
+def make_root(base: Path) -> LibraryRoot:
+    root = LibraryRoot(base)
+    for (name, tracks) in (('Album', [{'title': 'Söng', 'track': 1, 'duration': 180.5}, {'title': '', 'track': '2', 'duration': None}]),
+                           ('Other', [{'title': 'Other', 'artist': 'Band', 'albumartist': 'Band', 'duration': 60}])):
+        a = Album(base / name, ts=5)
+        for (i, data) in enumerate(tracks):
+            t = Track(base / name / f'0{i + 1}.mp3', data, ts=7)
+            t.size, t.mtime, t.digest = 100 + i, 200 + i, f'digest {i}'
+            t.album = a
+            a.tracks[str(t.path)] = t
+            root.tracks[str(t.path)] = t
+        a.rebuild_data()
+        root.albums[a.path] = a
+    root.moves = {str(base / 'Old'): str(base / 'Album')}
+    return root
+
+def test_round_trip(tmp_path: Path) -> None:
+    root = make_root(tmp_path)
+    columnar.save(root, tmp_path / 'root.bin')
+
+    loaded = columnar.load(tmp_path / 'root.bin')
+    assert (loaded.path_base, loaded.moves) == (root.path_base, root.moves)
+    assert set(loaded.tracks) == set(root.tracks)
+    for (key, t) in root.tracks.items():
+        u = loaded.tracks[key]
+        assert (u.path, u.ts_seen, u.size, u.mtime, u.digest, u.data) == (t.path, t.ts_seen, t.size, t.mtime, t.digest, t.data)
+        assert u.album is loaded.albums[t.album.path]
+        assert u.duration_deferred == (t.data['duration'] is None)
+    for (key, a) in root.albums.items():
+        assert (loaded.albums[key].ts_seen, loaded.albums[key].data) == (a.ts_seen, a.data)
+    columnar.release(loaded)
+
+def test_lazy_mapping_edits(tmp_path: Path) -> None:
+    root = make_root(tmp_path)
+    columnar.save(root, tmp_path / 'root.bin')
+    tracks = columnar.load(tmp_path / 'root.bin').tracks
+    gone, kept = sorted(root.tracks)[:2]
+
+    del tracks[gone]
+    tracks['added'] = None
+    assert gone not in tracks
+    assert kept in tracks
+    assert sorted(tracks) == sorted({*root.tracks, 'added'} - {gone})
+    assert len(tracks) == len(root.tracks)
+
+    tracks[gone] = None
+    assert tracks[gone] is None
+
+def test_release_before_overwrite(tmp_path: Path) -> None:
+    path = tmp_path / 'root.bin'
+    columnar.save(make_root(tmp_path), path)
+    loaded = columnar.load(path)
+    assert loaded.tracks._made == {}
+
+    # Saving over the file releases it first, materializing what was still mapped
+    columnar.save(loaded, path)
+    assert not hasattr(loaded, 'store')
+    assert isinstance(loaded.tracks, dict)
+    assert loaded.tracks[str(tmp_path / 'Other' / '01.mp3')].data['artist'] == 'Band'
+
+    reloaded = columnar.load(path)
+    assert {k: t.data for (k, t) in reloaded.tracks.items()} == {k: t.data for (k, t) in loaded.tracks.items()}
+    columnar.release(reloaded)
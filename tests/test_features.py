@@ -0,0 +1,33 @@
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import features
+from library import Album, Track
+
+def test_album_rows_round_trip(tmp_path: Path) -> None:
+    albums = []
+    for (i, artists) in enumerate(({'A', 'B'}, set())):
+        a = Album(Path(f'/music/Album {i}'), ts=10 + i)
+        a.data.update({'n_tracks': 3 + i, 'artists': artists, 'albumartists': {'A'}, 'duration': None if i else 95.5})
+        albums.append(a)
+    features.save(albums, tmp_path / 'albums.bin', Album)
+
+    table = features.FeatureTable(tmp_path / 'albums.bin')
+    assert len(table) == 2
+    for (i, a) in enumerate(albums):
+        row = table.row(i)
+        assert isinstance(row, Album)
+        assert (row.path, row.ts_seen, row.data) == (a.path, a.ts_seen, a.data)
+    table.close()
+
+def test_track_rows_round_trip(tmp_path: Path) -> None:
+    t = Track(Path('/music/01 Song.mp3'), {'title': 'Song', 'track': '1', 'duration': 181.0}, ts=7)
+    u = Track(Path('/music/02 Song.mp3'), {'title': '', 'track': 2}, ts=8)
+    features.save([t, u], tmp_path / 'tracks.bin')
+
+    table = features.FeatureTable(tmp_path / 'tracks.bin')
+    assert [table.row(i).data for i in range(2)] == [t.data, u.data]
+    assert (table.key(1), table.ts_seen(1)) == ('/music/02 Song.mp3', 8)
+    table.close()
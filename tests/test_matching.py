@@ -0,0 +1,42 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import matching
+from library import Album, Track
+
+def make_album(name: str, **data: object) -> Album:
+    a = Album(Path('/music') / name)
+    a.data.update({'n_tracks': 1, 'duration': 60.0})
+    a.data.update(data)
+    return a
+
+TRACKS = [
+    ({'title': 'Song', 'artist': 'Band'}, {'title': 'Song', 'artist': 'Band'}),
+    ({'title': 'Song', 'artist': 'Band'}, {'title': 'Song (Live)', 'artist': 'The Band'}),
+    ({'title': '', 'genre': ''}, {'title': '', 'genre': 'Rock'}),
+    ({'title': 'Song', 'track': 3}, {'title': 'Song', 'track': 4}),
+    ({'title': 'Song', 'track': '3'}, {'title': 'Song', 'track': '03'}),
+    ({'title': 'Song', 'duration': 180.0}, {'title': None, 'duration': 175.5}),
+    ({}, {}),
+]
+
+ALBUMS = [
+    ({'artists': {'A', 'B'}, 'albumartists': {'A'}}, {'artists': {'A', 'B'}, 'albumartists': {'A'}}),
+    ({'artists': set(), 'albumartists': {'A'}}, {'artists': {'A'}, 'albumartists': set()}),
+    ({'artists': set(), 'albumartists': set()}, {'artists': set(), 'albumartists': set()}),
+    ({'artists': {'Band'}, 'duration': 2400, 'n_tracks': 10}, {'artists': {'The Band', ''}, 'duration': None, 'n_tracks': 12}),
+]
+
+@pytest.mark.parametrize('d1, d2', TRACKS)
+def test_compiled_scorer_agrees_on_tracks(d1: dict, d2: dict) -> None:
+    t1, t2 = Track(Path('/music/01 x.mp3'), d1), Track(Path('/music/01 y.mp3'), d2)
+    assert matching.score_similarity(t1, t2) == pytest.approx(matching.score_similarity_generic(t1, t2))
+
+@pytest.mark.parametrize('d1, d2', ALBUMS)
+def test_compiled_scorer_agrees_on_albums(d1: dict, d2: dict) -> None:
+    a1, a2 = make_album('Album', **d1), make_album('Album (2001)', **d2)
+    assert matching.score_similarity(a1, a2) == pytest.approx(matching.score_similarity_generic(a1, a2))
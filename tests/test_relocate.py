@@ -0,0 +1,122 @@
+from pathlib import Path
+import io
+import random
+import struct
+import sys
+import wave
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import main
+import matching
+import tools
+
+def make_wav(path: Path, title: str, artist: str, album: str, seed: int) -> None:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(1)
+        w.setframerate(8000)
+        rnd = random.Random(seed)
+        w.writeframes(bytes(rnd.randrange(256) for _ in range(8000)))
+
+    # Tags as a RIFF INFO list after the audio
+    info = b'INFO'
+    for (k, v) in (('INAM', title), ('IART', artist), ('IPRD', album)):
+        data = v.encode() + b'\0'
+        if len(data) % 2:
+            data += b'\0'
+        info += k.encode() + struct.pack('<I', len(data)) + data
+    riff = buf.getvalue()[12:] + b'LIST' + struct.pack('<I', len(info)) + info
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'RIFF' + struct.pack('<I', 4 + len(riff)) + b'WAVE' + riff)
+
+def make_app(base: Path) -> main.App:
+    config = base / 'config.ini'
+    config.write_text('\n'.join([
+        f'BASE_OLD :: {base / "old"}',
+        f'BASE_NEW :: {base / "new"}',
+        f'BASE_CULL :: {base / "cull"}',
+        f'BASE_PICKLES :: {base / "pickles"}',
+    ]))
+
+    app = main.App()
+    app.PATH_CONFIG = config
+    app.load_configuration()
+    return app
+
+def test_decision_follows_moved_album(tmp_path: Path) -> None:
+    for i in range(3):
+        make_wav(tmp_path / 'old' / 'Artist' / 'Album' / f'0{i + 1} Song {i + 1}.wav', f'Song {i + 1}', 'Artist', 'Album', i)
+    make_wav(tmp_path / 'new' / 'Artist' / 'Album' / '01 Song 1.wav', 'Song 1', 'Artist', 'Album', 0)
+
+    main.app = make_app(tmp_path)
+    old, new = main.get_libraries()
+    a = old.albums[tmp_path / 'old' / 'Artist' / 'Album']
+    omitted = str(tmp_path / 'old' / 'Artist' / 'Album' / '03 Song 3.wav')
+    dec = matching.MatchDecision(a, None, matching.MatchState.PARTIAL, 0.9, tools.ts_now(), omit={omitted: None})
+    tools._pickle([dec], main.app.PATH_PICKLE_DECISIONS)
+
+    (tmp_path / 'old' / 'Artist' / 'Album').rename(tmp_path / 'old' / 'Artist' / 'Album (2001)')
+    old, new = main.get_libraries()
+
+    dec, = tools._unpickle(main.app.PATH_PICKLE_DECISIONS)
+    moved = tmp_path / 'old' / 'Artist' / 'Album (2001)'
+    assert dec.old is old.albums[moved]
+    assert list(dec.omit) == [str(moved / '03 Song 3.wav')]
+    assert main.get_unmatched_paths() == {moved / '01 Song 1.wav', moved / '02 Song 2.wav'}
+
+def test_cull_keeps_files_whose_source_is_gone(tmp_path: Path) -> None:
+    for i in range(2):
+        make_wav(tmp_path / 'old' / 'Artist' / 'Album' / f'0{i + 1} Song {i + 1}.wav', f'Song {i + 1}', 'Artist', 'Album', i)
+    (tmp_path / 'new').mkdir()
+
+    main.app = make_app(tmp_path)
+    old, new = main.get_libraries()
+    a = old.albums[tmp_path / 'old' / 'Artist' / 'Album']
+    dec = matching.MatchDecision(a, None, matching.MatchState.CONFIRMED_UNMATCHED, 0.0, tools.ts_now())
+    tools._pickle([dec], main.app.PATH_PICKLE_DECISIONS)
+
+    main.sync_cull()
+    culled = tmp_path / 'cull' / 'Artist' / 'Album'
+    assert sorted(p.name for p in culled.iterdir()) == ['01 Song 1.wav', '02 Song 2.wav']
+
+    (tmp_path / 'old' / 'Artist' / 'Album' / '02 Song 2.wav').unlink()
+    main.sync_cull()
+    assert sorted(p.name for p in culled.iterdir()) == ['01 Song 1.wav', '02 Song 2.wav']
+
+def test_keys_still_in_library_are_not_followed(tmp_path: Path) -> None:
+    for i in range(2):
+        make_wav(tmp_path / 'old' / 'Artist' / 'Album' / f'0{i + 1} Song {i + 1}.wav', f'Song {i + 1}', 'Artist', 'Album', i)
+    (tmp_path / 'new').mkdir()
+
+    main.app = make_app(tmp_path)
+    old, new = main.get_libraries()
+    album = tmp_path / 'old' / 'Artist' / 'Album'
+    omitted = str(album / '02 Song 2.wav')
+    dec = matching.MatchDecision(old.albums[album], None, matching.MatchState.PARTIAL, 0.9, tools.ts_now(), omit={omitted: None})
+    tools._pickle([dec], main.app.PATH_PICKLE_DECISIONS)
+
+    # Renamed away and back while a watcher held on to the moves
+    away = str(album / '02 Renamed.wav')
+    old.roots[0].moves = {omitted: away, away: omitted}
+    main.relocate_decisions(old, new, forget_moves=False)
+
+    dec, = tools._unpickle(main.app.PATH_PICKLE_DECISIONS)
+    assert list(dec.omit) == [omitted]
+    assert main.get_unmatched_paths() == {album / '01 Song 1.wav'}
+
+def test_escapee_stamps_follow_moved_tracks(tmp_path: Path) -> None:
+    make_wav(tmp_path / 'old' / 'Artist' / 'Album' / '01 Song 1.wav', 'Song 1', 'Artist', 'Album', 0)
+    (tmp_path / 'new').mkdir()
+
+    main.app = make_app(tmp_path)
+    main.get_libraries()
+    key = str(tmp_path / 'old' / 'Artist' / 'Album' / '01 Song 1.wav')
+    tools._pickle({key: 123}, main.app.PATH_PICKLE_ESCAPEES_SEEN)
+
+    (tmp_path / 'old' / 'Artist' / 'Album' / '01 Song 1.wav').rename(tmp_path / 'old' / 'Artist' / 'Album' / '01 Renamed.wav')
+    main.get_libraries()
+
+    assert tools._unpickle(main.app.PATH_PICKLE_ESCAPEES_SEEN) == {str(tmp_path / 'old' / 'Artist' / 'Album' / '01 Renamed.wav'): 123}
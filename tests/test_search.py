@@ -0,0 +1,30 @@
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import search
+
+def test_sync_keys_describes_only_new_keys() -> None:
+    index = search.SearchIndex()
+    index.add(('album', 'x'), 'Other Band')
+    described = []
+    def describe(text: str) -> str:
+        described.append(text)
+        return text
+
+    assert index.sync_keys({('dec', 1): 'Blue Album', ('dec', 2): 'Green Album'}, describe, 'dec')
+    assert sorted(described) == ['Blue Album', 'Green Album']
+    assert index.search('album') == [('dec', 1), ('dec', 2)]
+
+    described.clear()
+    assert not index.sync_keys({('dec', 1): 'Blue Album', ('dec', 2): 'Green Album'}, describe, 'dec')
+    assert described == []
+
+    # Dropped keys leave the index and their postings with them; other kinds are untouched
+    assert index.sync_keys({('dec', 2): 'Green Album', ('dec', 3): 'Red'}, describe, 'dec')
+    assert described == ['Red']
+    assert index.search('blue') == []
+    assert not any(('dec', 1) in posting for posting in index.postings.values())
+    assert index.search('band') == [('album', 'x')]
+    assert index.search('album') == [('dec', 2)]
@@ -0,0 +1,54 @@
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import matching
+import sessions
+from library import Album
+from tools import _unpickle
+
+def make_session(base: Path, reviewer: str, lease: float=60.0) -> sessions.ReviewSession:
+    return sessions.ReviewSession(reviewer, base / 'decisions.pickle', base / 'leases.pickle', base / 'decisions.lock', lease, batch=2)
+
+def test_claims_skip_keys_another_holds(tmp_path: Path) -> None:
+    ann, bob = make_session(tmp_path, 'ann'), make_session(tmp_path, 'bob')
+
+    assert ann.claim(['a', 'b', 'c']) == ({'a', 'b'}, set(), set())
+    assert bob.claim(['a', 'b', 'c', 'd']) == ({'c', 'd'}, {'a', 'b'}, set())
+
+    ann.close()
+    assert set(_unpickle(tmp_path / 'leases.pickle')) == {'c', 'd'}
+    assert bob.claim(['a']) == ({'a'}, set(), set())
+    bob.close()
+
+def test_lapsed_lease_is_taken_over(tmp_path: Path) -> None:
+    ann, bob = make_session(tmp_path, 'ann', lease=0.2), make_session(tmp_path, 'bob')
+    ann.closed.set() # No renewing in the background
+
+    assert ann.claim(['a']) == ({'a'}, set(), set())
+    time.sleep(0.3)
+    assert bob.claim(['a']) == ({'a'}, set(), set())
+
+    # Renewing must not steal it back
+    ann.renew()
+    assert ann.held == set()
+    assert _unpickle(tmp_path / 'leases.pickle')['a'][0] == 'bob'
+
+    ann.close()
+    assert _unpickle(tmp_path / 'leases.pickle')['a'][0] == 'bob'
+    bob.close()
+
+def test_keys_decided_by_another_are_not_claimed(tmp_path: Path) -> None:
+    ann, bob = make_session(tmp_path, 'ann'), make_session(tmp_path, 'bob')
+    assert bob.claim(['/old/a']) == ({'/old/a'}, set(), set())
+
+    dec = matching.MatchDecision(Album(Path('/old/a')), Album(Path('/new/a')), matching.MatchState.MATCHED, 0.9, ann.ts_start + 1)
+    assert len(bob.save([dec])) == 1
+    assert bob.held == set()
+    assert _unpickle(tmp_path / 'leases.pickle') == {}
+
+    assert ann.claim(['/old/a', '/old/b']) == ({'/old/b'}, set(), {'/new/a'})
+    ann.close()
+    bob.close()
@@ -0,0 +1,83 @@
+from pathlib import Path
+import os
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import tools
+
+def test_lock_breaks_abandoned_file(tmp_path: Path) -> None:
+    path = tmp_path / 'x.lock'
+    path.write_text('gone 1 abc')
+    os.utime(path, (1, 1))
+
+    with tools.FileLock(path, stale=1.0) as lock:
+        assert path.read_text() == lock.token
+    assert not path.exists()
+
+def test_lock_held_past_stale_is_kept_fresh(tmp_path: Path) -> None:
+    path = tmp_path / 'x.lock'
+    with tools.FileLock(path, stale=0.2) as lock:
+        time.sleep(0.5)
+        assert not tools.FileLock(path, stale=0.2)._break_stale()
+        assert path.read_text() == lock.token
+
+def test_lock_release_leaves_anothers_file(tmp_path: Path) -> None:
+    path = tmp_path / 'x.lock'
+    with tools.FileLock(path):
+        path.write_text('other 2 def')
+    assert path.read_text() == 'other 2 def'
+
+def test_concurrent_walk_skips_unreadable_folders(tmp_path: Path, monkeypatch: object) -> None:
+    for folder in ('a', 'b', 'b/c'):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / 'x.mp3').write_bytes(b'')
+
+    scandir = os.scandir
+    def _scandir(path: object) -> object:
+        if Path(path).name == 'b':
+            raise PermissionError(13, 'Permission denied', str(path))
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', _scandir)
+
+    assert tools.get_filepaths_concurrent(tmp_path, ['mp3'], concurrency=4) == {tmp_path / 'a' / 'x.mp3'}
+
+def test_token_bucket_holds_takers_to_rate() -> None:
+    bucket = tools.TokenBucket(100, 10)
+    ts = time.monotonic()
+    for _ in range(30):
+        bucket.take(1)
+
+    # The burst goes through at once, the other 20 at 100 a second
+    assert 0.18 <= time.monotonic() - ts < 0.6
+
+def test_throttle_meters_reads_and_files(tmp_path: Path) -> None:
+    path = tmp_path / 'x.bin'
+    path.write_bytes(b'x' * 30_000)
+
+    ts = time.monotonic()
+    with tools.limit_io(40_000, 20) as throttle:
+        for _ in range(6):
+            tools.take_file()
+        with tools.open_metered(path) as f:
+            assert len(f.read()) == 30_000
+    assert tools._throttle is None
+
+    # 10k burst, the other 20k at 40k a second; files stay within theirs
+    assert 0.45 <= time.monotonic() - ts < 1.2
+    assert (throttle.n_bytes, throttle.n_files) == (30_000, 6)
+
+def test_unlimited_io_is_left_alone(tmp_path: Path) -> None:
+    path = tmp_path / 'x.bin'
+    path.write_bytes(b'x')
+
+    with tools.limit_io(0, 0):
+        assert tools._throttle is None
+        with tools.open_metered(path) as f:
+            assert not isinstance(f.raw, tools._MeteredReader)
+
+    outer, inner = tools.Throttle(1e9), tools.Throttle(1e9)
+    with outer, inner:
+        assert tools._throttle is inner
+    assert tools._throttle is None